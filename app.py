@@ -1,11 +1,35 @@
 import os
 import logging
+import multiprocessing
 import requests
 import base64
+import bisect
+import contextlib
+import hashlib
+import heapq
 import io
 import json
+import queue
+import re
+import shutil
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote
+from urllib3.util.retry import Retry
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it images are sent as generated
+    Image = None
 
 # Enable logging
 logging.basicConfig(
@@ -19,12 +43,627 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 STABILITY_API_KEY = os.getenv("STABILITY_API_KEY")
 HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY")  # Optional
 
+# Service base URLs (overridden to point at local stand-ins in benchmarks)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+STABILITY_API_BASE = os.getenv("STABILITY_API_BASE", "https://api.stability.ai").rstrip("/")
+POLLINATIONS_API_BASE = os.getenv("POLLINATIONS_API_BASE", "https://image.pollinations.ai").rstrip("/")
+HUGGINGFACE_API_BASE = os.getenv("HUGGINGFACE_API_BASE", "https://api-inference.huggingface.co").rstrip("/")
+
+# Outbound HTTP settings
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))  # Keep-alive connections per host
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+PROVIDER_READ_TIMEOUT = float(os.getenv("PROVIDER_READ_TIMEOUT", "60"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))  # Only idempotent requests are retried
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))
+
+# Outbound Telegram rate limits (https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))  # Calls per second for the whole bot
+# Processes sending to Telegram (web workers plus generate workers). Each one gets an equal share of the global rate.
+# gunicorn and Heroku use WEB_CONCURRENCY for the worker count, so that is the default.
+TELEGRAM_RATE_PROCESSES = max(1, int(os.getenv("TELEGRAM_RATE_PROCESSES", os.getenv("WEB_CONCURRENCY", "1"))))
+TELEGRAM_PROCESS_RATE = TELEGRAM_GLOBAL_RATE / TELEGRAM_RATE_PROCESSES
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))  # Calls per second per chat
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_SENDER_THREADS = int(os.getenv("TELEGRAM_SENDER_THREADS", "4"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))  # Retries after a 429
+
+# Image streaming settings
+STREAM_CHUNK_BYTES = int(os.getenv("STREAM_CHUNK_BYTES", str(64 * 1024)))
+IMAGE_SPOOL_BYTES = int(os.getenv("IMAGE_SPOOL_BYTES", str(1024 * 1024)))  # Per-job RAM before spilling to a temp file
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))  # Larger provider outputs are discarded
+
+# Image post-processing settings
+IMAGE_POSTPROCESS_WORKERS = int(os.getenv("IMAGE_POSTPROCESS_WORKERS", "2"))  # 0 disables post-processing
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "jpeg").lower()  # original, jpeg or webp
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "90"))
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1280"))  # Telegram shows photos at most 1280px wide
+IMAGE_STRIP_METADATA = os.getenv("IMAGE_STRIP_METADATA", "true").lower() == "true"
+
+# Prompt -> image cache settings
+IMAGE_CACHE_MEMORY_ITEMS = int(os.getenv("IMAGE_CACHE_MEMORY_ITEMS", "64"))
+IMAGE_CACHE_MEMORY_ITEM_BYTES = int(os.getenv("IMAGE_CACHE_MEMORY_ITEM_BYTES", str(1024 * 1024)))  # Bigger images stay on disk only
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "/tmp/imagify_cache")  # Empty disables the disk tier
+IMAGE_CACHE_DISK_BYTES = int(os.getenv("IMAGE_CACHE_DISK_BYTES", str(500 * 1024 * 1024)))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", "86400"))  # Seconds
+IMAGE_CACHE_TMP_MAX_AGE = 3600  # Seconds before a half-written file left by a crashed process is deleted
+
+# Provider parameters (also part of the cache key)
+STABILITY_PARAMS = {
+    "cfg_scale": 7,
+    "height": 512,
+    "width": 512,
+    "samples": 1,
+    "steps": 30,
+}
+HUGGINGFACE_MODEL = "runwayml/stable-diffusion-v1-5"
+
+# Provider routing settings
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "8"))  # Seconds before a backup provider races the first (0 disables)
+PROVIDER_EWMA_ALPHA = float(os.getenv("PROVIDER_EWMA_ALPHA", "0.3"))  # Weight of the newest latency/error sample
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "60"))
+PROVIDER_PROBE_INTERVAL = float(os.getenv("PROVIDER_PROBE_INTERVAL", "60"))  # Seconds between background health probes (0 disables)
+
+# Duplicate update suppression settings
+UPDATE_DEDUP_BACKEND = os.getenv("UPDATE_DEDUP_BACKEND", "memory").lower()  # memory or sqlite (shared by all workers)
+UPDATE_DEDUP_DB = os.getenv("UPDATE_DEDUP_DB", "/tmp/imagify_updates.sqlite3")
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "3600"))  # Seconds an update_id is remembered
+UPDATE_DEDUP_MAX = int(os.getenv("UPDATE_DEDUP_MAX", "100000"))  # update_ids remembered at most
+
+# Background worker pool settings
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+# Where accepted prompts wait for a worker:
+#   "memory" - this process's worker pool (lost on restart)
+#   "sqlite" - a durable job table drained by "python app.py generate" processes
+JOB_STORE = os.getenv("JOB_STORE", "memory").lower()
+JOB_STORE_DB = os.getenv("JOB_STORE_DB", "/tmp/imagify_jobs.sqlite3")
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))  # A crashed worker's jobs are retried after this
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+# Long-polling mode ("python app.py poll") settings
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "50"))  # Seconds Telegram holds getUpdates open
+POLL_BATCH = int(os.getenv("POLL_BATCH", "100"))  # Updates per getUpdates call (Telegram's maximum)
+POLL_WORKERS = int(os.getenv("POLL_WORKERS", "4"))  # Worker processes, each owning a share of the chats
+POLL_OFFSET_FILE = os.getenv("POLL_OFFSET_FILE", "/tmp/imagify_poll_offset.json")
+# What to do when the job queue is full:
+#   "reject" - answer 503 so Telegram redelivers the update later
+#   "notify" - tell the user the bot is busy and drop the update
+QUEUE_OVERFLOW_POLICY = os.getenv("QUEUE_OVERFLOW_POLICY", "reject").lower()
+
 # Create Flask app (this is what Gunicorn needs)
 app = Flask(__name__)
 
-def send_telegram_message(chat_id, text):
+def _create_http_session():
+    """Build the shared HTTP session with per-host keep-alive pools"""
+    def adapter(**retry_options):
+        retry = Retry(
+            total=HTTP_RETRIES,
+            backoff_factor=HTTP_RETRY_BACKOFF,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,  # GET/HEAD/PUT/DELETE/OPTIONS/TRACE, never POST
+            raise_on_status=False,
+            **retry_options,
+        )
+        return HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    
+    session = requests.Session()
+    default = adapter()
+    session.mount("https://", default)
+    session.mount("http://", default)
+    
+    # Image generation never retries a read timeout: the provider may still be
+    # working, and a retried GET would start a whole new generation
+    generation = adapter(read=0)
+    for prefix in (f"{STABILITY_API_BASE}/v1/generation/", f"{POLLINATIONS_API_BASE}/prompt/", f"{HUGGINGFACE_API_BASE}/models/"):
+        session.mount(prefix, generation)
+    return session
+
+http_session = _create_http_session()
+
+def http_request(method, url, read_timeout=None, **kwargs):
+    """Send a request through the shared session with split connect/read timeouts"""
+    timeout = (HTTP_CONNECT_TIMEOUT, read_timeout or HTTP_READ_TIMEOUT)
+    return http_session.request(method, url, timeout=timeout, **kwargs)
+
+def http_stats():
+    """Per-host connection reuse counters from the shared session"""
+    hosts = {}
+    for adapter in set(http_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = f"{key.key_scheme}://{key.key_host}:{key.key_port}"
+            entry = hosts.setdefault(host, {"connections_opened": 0, "requests": 0})
+            entry["connections_opened"] += pool.num_connections
+            entry["requests"] += pool.num_requests
+    return {"pool_size": HTTP_POOL_SIZE, "hosts": hosts}
+
+def telegram_api_url(method):
+    """Build a Telegram Bot API URL"""
+    return f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/{method}"
+
+# Metrics (Prometheus text exposition format, served on /metrics)
+WEBHOOK_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+TELEGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PROVIDER_BUCKETS = (0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0, 120.0)
+METRICS = []
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Metric:
+    """A metric family with optional labels, rendered in the Prometheus text format"""
+    kind = "untyped"
+    
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values = {}  # tuple of label values -> value
+        self.lock = threading.Lock()
+        METRICS.append(self)
+    
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+    
+    def _series(self, suffix, key, value, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        label_text = ",".join(f'{name}="{_escape_label(v)}"' for name, v in pairs)
+        return f"{self.name}{suffix}{{{label_text}}} {value}" if label_text else f"{self.name}{suffix} {value}"
+    
+    def samples(self):
+        with self.lock:
+            return [self._series("", key, value) for key, value in self.values.items()]
+    
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """A value that goes up and down, or is read from collect() at scrape time"""
+    kind = "gauge"
+    
+    def __init__(self, name, help_text, labels=(), collect=None):
+        super().__init__(name, help_text, labels)
+        self.collect = collect  # collect() -> value, or {label value(s): value} for labelled gauges
+        if not self.labels:
+            self.values[()] = 0
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    @contextlib.contextmanager
+    def track(self, **labels):
+        """Count the enclosed block as in flight"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+    
+    def samples(self):
+        if self.collect is None:
+            return super().samples()
+        try:
+            collected = self.collect()
+        except Exception as e:
+            logger.error(f"Error collecting metric {self.name}: {e}")
+            return []
+        if not isinstance(collected, dict):
+            return [self._series("", (), collected)]
+        return [self._series("", key if isinstance(key, tuple) else (key,), value) for key, value in collected.items()]
+
+class Histogram(Metric):
+    kind = "histogram"
+    
+    def __init__(self, name, help_text, labels=(), buckets=TELEGRAM_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]  # per-bucket counts, +Inf, sum
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+    
+    def samples(self):
+        lines = []
+        with self.lock:
+            for key, counts in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(self._series("_bucket", key, cumulative, extra=(("le", bound),)))
+                lines.append(self._series("_sum", key, round(counts[-1], 6)))
+                lines.append(self._series("_count", key, cumulative))
+        return lines
+
+def render_metrics():
+    """All registered metrics as a Prometheus text exposition"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def _body_size(body):
+    """Length of a request body (bytes, str or a sized stream), 0 if unknown"""
+    try:
+        return len(body) if body is not None else 0
+    except TypeError:
+        return 0
+
+WEBHOOK_SECONDS = Histogram("imagify_webhook_duration_seconds", "Time to accept or reject a webhook update", ("status",), WEBHOOK_BUCKETS)
+WEBHOOK_IN_FLIGHT = Gauge("imagify_webhook_in_flight", "Webhook requests being handled")
+PROVIDER_SECONDS = Histogram("imagify_provider_duration_seconds", "Image generation call latency", ("provider", "outcome"), PROVIDER_BUCKETS)
+PROVIDER_CALLS = Counter("imagify_provider_calls_total", "Image generation calls by outcome", ("provider", "outcome"))
+PROVIDER_IN_FLIGHT = Gauge("imagify_provider_in_flight", "Image generation calls running", ("provider",))
+TELEGRAM_SECONDS = Histogram("imagify_telegram_duration_seconds", "Telegram Bot API call latency", ("method", "status"), TELEGRAM_BUCKETS)
+TELEGRAM_IN_FLIGHT = Gauge("imagify_telegram_in_flight", "Telegram Bot API calls running")
+TRANSFER_BYTES = Counter("imagify_bytes_total", "Payload bytes received (in) and sent (out) per peer", ("direction", "peer"))
+
+def observe_provider_call(name, image, seconds):
+    """Record one image generation call"""
+    outcome = "success" if image else "failure"
+    PROVIDER_SECONDS.observe(seconds, provider=name, outcome=outcome)
+    PROVIDER_CALLS.inc(provider=name, outcome=outcome)
+    if image:
+        TRANSFER_BYTES.inc(image_size(image), direction="in", peer="provider")
+
+def observe_telegram_call(method, status, seconds, sent_bytes=0, received_bytes=0):
+    """Record one Telegram Bot API call (status is the HTTP code or "error")"""
+    TELEGRAM_SECONDS.observe(seconds, method=method, status=status)
+    TRANSFER_BYTES.inc(sent_bytes, direction="out", peer="telegram")
+    TRANSFER_BYTES.inc(received_bytes, direction="in", peer="telegram")
+
+# Streaming image bodies
+class Base64ArtifactDecoder:
+    """Decode the first "base64" string of a streamed JSON body without buffering the whole body"""
+    
+    START = re.compile(rb'"base64"\s*:\s*"')
+    
+    def __init__(self, out):
+        self.out = out
+        self.state = "seek"  # seek -> value -> done
+        self.buffer = b""
+    
+    def feed(self, chunk):
+        data = self.buffer + chunk
+        self.buffer = b""
+        
+        if self.state == "seek":
+            match = self.START.search(data)
+            if not match:
+                # Keep enough of the tail to catch a key split across chunks
+                self.buffer = data[-64:]
+                return
+            self.state = "value"
+            data = data[match.end():]
+        
+        if self.state == "value":
+            end = data.find(b'"')
+            value = (data if end < 0 else data[:end]).replace(b"\\", b"")  # JSON may escape "/" as "\/"
+            if end >= 0:
+                self.out.write(base64.b64decode(value))
+                self.state = "done"
+                return
+            # Decode whole 4-character groups, carry the remainder to the next chunk
+            usable = len(value) // 4 * 4
+            self.out.write(base64.b64decode(value[:usable]))
+            self.buffer = value[usable:]
+    
+    def finish(self):
+        return self.state == "done"
+
+class ImageSink:
+    """Collect a streamed provider body in a spooled temp file, enforcing MAX_IMAGE_BYTES"""
+    
+    def __init__(self, base64_artifact=False):
+        self.file = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_BYTES)
+        self.decoder = Base64ArtifactDecoder(self.file) if base64_artifact else None
+    
+    def write(self, chunk):
+        """Add a chunk. Returns False once the image is over the size ceiling."""
+        if self.decoder:
+            self.decoder.feed(chunk)
+        else:
+            self.file.write(chunk)
+        return self.file.tell() <= MAX_IMAGE_BYTES
+    
+    def finish(self):
+        """The image rewound for reading, or None if nothing usable arrived"""
+        if (self.decoder and not self.decoder.finish()) or self.file.tell() == 0:
+            self.file.close()
+            return None
+        self.file.seek(0)
+        return self.file
+    
+    def discard(self):
+        self.file.close()
+
+def read_image_stream(response, base64_artifact=False):
+    """Stream a provider response into a spooled file. Returns None if it is empty, malformed or too large."""
+    sink = ImageSink(base64_artifact)
+    for chunk in response.iter_content(STREAM_CHUNK_BYTES):
+        if not sink.write(chunk):
+            logger.error(f"Image from {response.url} is larger than {MAX_IMAGE_BYTES} bytes, discarding")
+            sink.discard()
+            return None
+    return sink.finish()
+
+def image_size(image):
+    """Size of a file-like image without reading it"""
+    position = image.tell()
+    size = image.seek(0, os.SEEK_END)
+    image.seek(position)
+    return size
+
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png", "image/png"),
+    (b"\xff\xd8\xff", "jpeg", "image/jpeg"),
+    (b"GIF87a", "gif", "image/gif"),
+    (b"GIF89a", "gif", "image/gif"),
+)
+
+def detect_image_format(image):
+    """Real format of a file-like image from its magic bytes: (format, mime type)"""
+    position = image.tell()
+    image.seek(0)
+    head = image.read(12)
+    image.seek(position)
+    
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp", "image/webp"
+    for signature, image_format, mime_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format, mime_type
+    return "png", "image/png"  # What the providers are documented to return
+
+class MultipartStream:
+    """multipart/form-data body that reads the file part lazily instead of building it in memory"""
+    
+    def __init__(self, fields, name, filename, content_type, fileobj):
+        boundary = os.urandom(16).hex()
+        head = b"".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode("utf-8")
+            for key, value in fields.items()
+        )
+        head += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+        
+        fileobj.seek(0)
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self.length = len(head) + image_size(fileobj) + len(tail)
+        self.parts = [io.BytesIO(head), fileobj, io.BytesIO(tail)]
+    
+    def __len__(self):
+        return self.length
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        chunks = []
+        while self.parts and size > 0:
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.pop(0)
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+    
+    def __iter__(self):
+        while True:
+            chunk = self.read(STREAM_CHUNK_BYTES)
+            if not chunk:
+                return
+            yield chunk
+
+# Outbound Telegram dispatcher: every send goes through one priority queue
+# paced by a global and a per-chat token bucket
+PRIORITY_PHOTO = 0  # Final images first
+PRIORITY_MESSAGE = 1
+PRIORITY_CHAT_ACTION = 2  # "typing"/"uploading" indicators last
+
+class TokenBucket:
+    """Token bucket rate limiter that reports waits instead of sleeping (not thread-safe)"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+    
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, now):
+        """Seconds until a token is available"""
+        self._refill(now)
+        wait_for = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait_for = max(wait_for, (1 - self.tokens) / self.rate)
+        return wait_for
+    
+    def take(self):
+        self.tokens -= 1
+    
+    def pause(self, seconds):
+        """Hold the bucket for a server-imposed retry_after"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+def retry_after_seconds(status_code, body):
+    """Telegram's retry_after for a 429 response body (dict), or None if the call was not throttled"""
+    if status_code != 429:
+        return None
+    try:
+        return float((body or {}).get("parameters", {}).get("retry_after", 1))
+    except (TypeError, ValueError, AttributeError):
+        return 1.0
+
+_global_bucket = TokenBucket(TELEGRAM_PROCESS_RATE, max(1, int(TELEGRAM_PROCESS_RATE)))
+_chat_buckets = OrderedDict()  # chat_id -> TokenBucket, least recently used first
+_outbox = []  # heap of (priority, seq, job) ready to send
+_delayed = []  # heap of (ready_at, seq, job) waiting on a chat limit or retry_after
+_outbox_cond = threading.Condition()
+_outbox_seq = 0
+_senders = []
+_dispatch_stats = {"sent": 0, "throttled": 0, "retried": 0, "dropped": 0, "errors": 0}
+
+def _bump_dispatch_stat(name):
+    with _outbox_cond:
+        _dispatch_stats[name] += 1
+
+def _chat_bucket(chat_id):
+    """Per-chat bucket (caller holds _outbox_cond)"""
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _chat_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        while len(_chat_buckets) > 10000:
+            _chat_buckets.popitem(last=False)
+    _chat_buckets.move_to_end(chat_id)
+    return bucket
+
+def _push(heap, key, job):
+    """Queue a job (caller holds _outbox_cond)"""
+    global _outbox_seq
+    _outbox_seq += 1
+    heapq.heappush(heap, (key, _outbox_seq, job))
+    _outbox_cond.notify()
+
+def _next_outbound_job():
+    """Block until a job is allowed to go out under both rate limits"""
+    with _outbox_cond:
+        while True:
+            now = time.monotonic()
+            while _delayed and _delayed[0][0] <= now:
+                job = heapq.heappop(_delayed)[2]
+                _push(_outbox, job["priority"], job)
+            
+            if not _outbox:
+                _outbox_cond.wait(_delayed[0][0] - now if _delayed else None)
+                continue
+            
+            job = _outbox[0][2]
+            chat_delay = _chat_bucket(job["chat_id"]).delay(now) if job["chat_id"] is not None else 0.0
+            if chat_delay > 0:
+                # Park it so other chats can go ahead
+                heapq.heappop(_outbox)
+                _push(_delayed, now + chat_delay, job)
+                continue
+            
+            global_delay = _global_bucket.delay(now)
+            if global_delay > 0:
+                _outbox_cond.wait(global_delay)
+                continue
+            
+            heapq.heappop(_outbox)
+            _global_bucket.take()
+            if job["chat_id"] is not None:
+                _chat_bucket(job["chat_id"]).take()
+            return job
+
+def _sender_loop():
+    """Send queued Telegram calls, rescheduling throttled ones"""
+    while True:
+        job = _next_outbound_job()
+        started = time.monotonic()
+        try:
+            with TELEGRAM_IN_FLIGHT.track():
+                response = job["send"]()
+        except Exception as e:
+            observe_telegram_call(job["method"], "error", time.monotonic() - started)
+            _bump_dispatch_stat("errors")
+            job["future"].set_exception(e)
+            continue
+        
+        observe_telegram_call(
+            job["method"], response.status_code, time.monotonic() - started,
+            _body_size(response.request.body), len(response.content),
+        )
+        try:
+            body = response.json() if response.status_code == 429 else None
+        except ValueError:
+            body = None
+        retry_after = retry_after_seconds(response.status_code, body)
+        
+        if retry_after is None:
+            _bump_dispatch_stat("sent")
+            job["future"].set_result(response)
+            continue
+        
+        with _outbox_cond:
+            _dispatch_stats["throttled"] += 1
+            if job["chat_id"] is not None:
+                _chat_bucket(job["chat_id"]).pause(retry_after)
+            else:
+                _global_bucket.pause(retry_after)
+            
+            if job["attempts"] >= TELEGRAM_MAX_RETRIES:
+                _dispatch_stats["dropped"] += 1
+                logger.warning(f"Giving up on Telegram call for chat {job['chat_id']} after {job['attempts']} retries")
+                job["future"].set_result(response)
+                continue
+            
+            job["attempts"] += 1
+            _dispatch_stats["retried"] += 1
+            logger.info(f"Telegram asked to retry after {retry_after:.0f}s (chat {job['chat_id']})")
+            _push(_delayed, time.monotonic() + retry_after, job)
+
+def _start_senders():
+    with _outbox_cond:
+        _senders[:] = [t for t in _senders if t.is_alive()]
+        for i in range(len(_senders), TELEGRAM_SENDER_THREADS):
+            sender = threading.Thread(target=_sender_loop, name=f"imagify-telegram-{i}", daemon=True)
+            sender.start()
+            _senders.append(sender)
+
+def telegram_dispatch(chat_id, priority, send, method="other"):
+    """Queue a Telegram call; send() performs it and returns the response. Returns a Future."""
+    if len(_senders) < TELEGRAM_SENDER_THREADS:
+        _start_senders()
+    
+    job = {"chat_id": chat_id, "priority": priority, "send": send, "method": method, "attempts": 0, "future": Future()}
+    with _outbox_cond:
+        _push(_outbox, priority, job)
+    return job["future"]
+
+def dispatcher_stats():
+    """Snapshot of the outbound Telegram queue"""
+    with _outbox_cond:
+        stats = dict(_dispatch_stats)
+        stats["queued"] = len(_outbox)
+        stats["delayed"] = len(_delayed)
+        stats["chats_tracked"] = len(_chat_buckets)
+    return stats
+
+def send_telegram_message(chat_id, text, wait=True):
     """Send a text message via Telegram API"""
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+    url = telegram_api_url("sendMessage")
     data = {
         "chat_id": chat_id,
         "text": text,
@@ -32,32 +671,55 @@ def send_telegram_message(chat_id, text):
     }
     
     try:
-        response = requests.post(url, json=data, timeout=30)
-        return response.status_code == 200
+        future = telegram_dispatch(chat_id, PRIORITY_MESSAGE, lambda: http_request("POST", url, json=data), "sendMessage")
+        if not wait:
+            return True
+        return future.result().status_code == 200
     except Exception as e:
         logger.error(f"Error sending message: {e}")
         return False
 
+def send_telegram_chat_action(chat_id, action="upload_photo"):
+    """Show a chat action ("uploading photo...") without waiting for it to be sent"""
+    url = telegram_api_url("sendChatAction")
+    telegram_dispatch(chat_id, PRIORITY_CHAT_ACTION, lambda: http_request("POST", url, json={"chat_id": chat_id, "action": action}), "sendChatAction")
+    return True
+
+def photo_file_id(message):
+    """Extract the file_id of the largest photo size from a sent Telegram message"""
+    photos = (message or {}).get("photo") or []
+    return photos[-1].get("file_id") if photos else None
+
 def send_telegram_photo(chat_id, photo_data, caption):
-    """Send a photo via Telegram API"""
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto"
+    """Send a photo (file-like) via Telegram API. Returns the sent message on success, None on failure."""
+    url = telegram_api_url("sendPhoto")
     
     try:
-        files = {'photo': ('image.png', photo_data, 'image/png')}
         data = {
             'chat_id': chat_id,
             'caption': caption
         }
+        image_format, mime_type = detect_image_format(photo_data)
         
-        response = requests.post(url, files=files, data=data, timeout=60)
-        return response.status_code == 200
+        def send():
+            # Streamed straight from the image file, never assembled in memory
+            body = MultipartStream(data, 'photo', f'image.{image_format}', mime_type, photo_data)
+            return http_request(
+                "POST", url, read_timeout=PROVIDER_READ_TIMEOUT,
+                data=body, headers={"Content-Type": body.content_type}
+            )
+        
+        response = telegram_dispatch(chat_id, PRIORITY_PHOTO, send, "sendPhoto").result()
+        if response.status_code != 200:
+            return None
+        return response.json().get("result") or {"ok": True}
     except Exception as e:
         logger.error(f"Error sending photo: {e}")
-        return False
+        return None
 
 def send_telegram_photo_url(chat_id, photo_url, caption):
-    """Send a photo by URL via Telegram API"""
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto"
+    """Send a photo by URL (or by a Telegram file_id) via Telegram API"""
+    url = telegram_api_url("sendPhoto")
     data = {
         "chat_id": chat_id,
         "photo": photo_url,
@@ -65,7 +727,7 @@ def send_telegram_photo_url(chat_id, photo_url, caption):
     }
     
     try:
-        response = requests.post(url, json=data, timeout=30)
+        response = telegram_dispatch(chat_id, PRIORITY_PHOTO, lambda: http_request("POST", url, json=data), "sendPhoto").result()
         return response.status_code == 200
     except Exception as e:
         logger.error(f"Error sending photo URL: {e}")
@@ -75,7 +737,7 @@ def generate_image_huggingface(prompt):
     """Generate image using Hugging Face API (Free tier available)"""
     try:
         # Using Stable Diffusion model on Hugging Face
-        api_url = "https://api-inference.huggingface.co/models/runwayml/stable-diffusion-v1-5"
+        api_url = f"{HUGGINGFACE_API_BASE}/models/{HUGGINGFACE_MODEL}"
         
         headers = {}
         if HUGGINGFACE_API_KEY:
@@ -83,13 +745,12 @@ def generate_image_huggingface(prompt):
         
         payload = {"inputs": prompt}
         
-        response = requests.post(api_url, headers=headers, json=payload, timeout=60)
-        
-        if response.status_code == 200:
-            return response.content  # Returns image bytes directly
-        else:
-            logger.error(f"Hugging Face API error: {response.status_code} - {response.text}")
-            return None
+        with http_request("POST", api_url, read_timeout=PROVIDER_READ_TIMEOUT, headers=headers, json=payload, stream=True) as response:
+            if response.status_code == 200:
+                return read_image_stream(response)  # Image bytes are streamed directly
+            else:
+                logger.error(f"Hugging Face API error: {response.status_code} - {response.text}")
+                return None
             
     except Exception as e:
         logger.error(f"Error generating image with Hugging Face: {e}")
@@ -101,30 +762,21 @@ def generate_image_stability(prompt):
         return None
         
     try:
-        url = "https://api.stability.ai/v1/generation/stable-diffusion-v1-6/text-to-image"
+        url = f"{STABILITY_API_BASE}/v1/generation/stable-diffusion-v1-6/text-to-image"
         
         headers = {
             "Authorization": f"Bearer {STABILITY_API_KEY}",
             "Content-Type": "application/json"
         }
         
-        data = {
-            "text_prompts": [{"text": prompt}],
-            "cfg_scale": 7,
-            "height": 512,
-            "width": 512,
-            "samples": 1,
-            "steps": 30,
-        }
-        
-        response = requests.post(url, json=data, headers=headers, timeout=60)
+        data = {"text_prompts": [{"text": prompt}], **STABILITY_PARAMS}
         
-        if response.status_code == 200:
-            result = response.json()
-            if "artifacts" in result and len(result["artifacts"]) > 0:
-                return base64.b64decode(result["artifacts"][0]["base64"])
-        else:
-            logger.error(f"Stability AI API error: {response.status_code} - {response.text}")
+        with http_request("POST", url, read_timeout=PROVIDER_READ_TIMEOUT, json=data, headers=headers, stream=True) as response:
+            if response.status_code == 200:
+                # Decode artifacts[0].base64 as it arrives instead of parsing the whole JSON body
+                return read_image_stream(response, base64_artifact=True)
+            else:
+                logger.error(f"Stability AI API error: {response.status_code} - {response.text}")
             
     except Exception as e:
         logger.error(f"Error generating image with Stability: {e}")
@@ -135,108 +787,1319 @@ def generate_image_pollinations(prompt):
     """Generate image using Pollinations AI (Free service)"""
     try:
         # Pollinations.ai free API
-        url = f"https://image.pollinations.ai/prompt/{quote(prompt)}"
-        response = requests.get(url, timeout=60)
-        
-        if response.status_code == 200:
-            return response.content
-        else:
-            logger.error(f"Pollinations API error: {response.status_code}")
-            return None
+        url = f"{POLLINATIONS_API_BASE}/prompt/{quote(prompt)}"
+        with http_request("GET", url, read_timeout=PROVIDER_READ_TIMEOUT, stream=True) as response:
+            if response.status_code == 200:
+                return read_image_stream(response)
+            else:
+                logger.error(f"Pollinations API error: {response.status_code}")
+                return None
             
     except Exception as e:
         logger.error(f"Error generating image with Pollinations: {e}")
         return None
 
+# Cheap health probes: reachability and credentials only, no image is generated
+def probe_stability():
+    """List the Stability AI engines"""
+    response = http_request("GET", f"{STABILITY_API_BASE}/v1/engines/list", headers={"Authorization": f"Bearer {STABILITY_API_KEY}"})
+    return response.status_code == 200
+
+def probe_pollinations():
+    """List the Pollinations image models"""
+    return http_request("GET", f"{POLLINATIONS_API_BASE}/models").status_code == 200
+
+def probe_huggingface():
+    """Ask Hugging Face whether the model can be served"""
+    headers = {"Authorization": f"Bearer {HUGGINGFACE_API_KEY}"} if HUGGINGFACE_API_KEY else {}
+    response = http_request("GET", f"{HUGGINGFACE_API_BASE}/status/{HUGGINGFACE_MODEL}", headers=headers)
+    return response.status_code == 200
+
+# Provider router
+class ImageProvider:
+    """An image generation backend with rolling health statistics"""
+    
+    def __init__(self, name, generate, is_enabled=None, probe=None):
+        self.name = name
+        self.generate = generate  # generate(prompt) -> file-like image or None
+        self.is_enabled = is_enabled or (lambda: True)
+        self.probe = probe  # probe() -> True if the service looks usable; must not generate anything
+        self.latency = None  # EWMA of successful call latency, seconds
+        self.error_rate = 0.0  # EWMA of failures, 0..1
+        self.consecutive_failures = 0
+        self.open_until = 0.0  # Circuit breaker open until this time.monotonic()
+        self.trial_in_flight = False  # Half-open probe currently running
+        self.lock = threading.Lock()
+    
+    def available(self, now):
+        """Closed circuit, or half-open with no trial running yet"""
+        with self.lock:
+            if not self.open_until:
+                return True
+            return now >= self.open_until and not self.trial_in_flight
+    
+    def begin(self):
+        """Claim a call. Returns None if the circuit is open or its half-open trial is taken, else whether this call is the trial."""
+        with self.lock:
+            if not self.open_until:
+                return False
+            if time.monotonic() < self.open_until or self.trial_in_flight:
+                return None
+            self.trial_in_flight = True
+            return True
+    
+    def abandon(self, trial):
+        """A call was cancelled before finishing; it counts as neither success nor failure"""
+        if trial:
+            with self.lock:
+                self.trial_in_flight = False
+    
+    def expected_cost(self):
+        """Lower is better: latency inflated by the chance of having to fall through"""
+        if self.latency is None:
+            return 0.0  # Untried providers go first so they get measured
+        return self.latency / max(0.05, 1.0 - self.error_rate)
+    
+    def record(self, success, latency, trial=False):
+        with self.lock:
+            alpha = PROVIDER_EWMA_ALPHA
+            self.error_rate = (1 - alpha) * self.error_rate + alpha * (0.0 if success else 1.0)
+            if trial:
+                self.trial_in_flight = False  # Only the trial's own result decides the half-open state
+            
+            if success:
+                self.latency = latency if self.latency is None else (1 - alpha) * self.latency + alpha * latency
+                self.consecutive_failures = 0
+                self.open_until = 0.0
+                return
+            
+            self.consecutive_failures += 1
+            if trial or self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                if not self.open_until or trial:
+                    logger.warning(f"Opening circuit for {self.name} for {CIRCUIT_RESET_SECONDS:.0f}s")
+                self.open_until = time.monotonic() + CIRCUIT_RESET_SECONDS
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "latency_seconds": self.latency,
+                "error_rate": round(self.error_rate, 3),
+                "consecutive_failures": self.consecutive_failures,
+                "circuit": "open" if self.open_until > time.monotonic() else ("half-open" if self.open_until else "closed"),
+                "enabled": self.is_enabled(),
+            }
+
+PROVIDERS = []
+_provider_pool = ThreadPoolExecutor(max_workers=WORKER_POOL_SIZE * 2, thread_name_prefix="imagify-provider")
+
+def register_provider(name, generate, is_enabled=None, probe=None):
+    """Add an image generation backend. Earlier registrations win ties."""
+    provider = ImageProvider(name, generate, is_enabled, probe)
+    PROVIDERS.append(provider)
+    return provider
+
+register_provider("Stability AI", generate_image_stability, is_enabled=lambda: bool(STABILITY_API_KEY), probe=probe_stability)
+register_provider("Pollinations AI", generate_image_pollinations, probe=probe_pollinations)
+register_provider("Hugging Face", generate_image_huggingface, probe=probe_huggingface)
+
+def route_providers():
+    """Enabled providers with a usable circuit, fastest expected first"""
+    now = time.monotonic()
+    candidates = [p for p in PROVIDERS if p.is_enabled() and p.available(now)]
+    return sorted(candidates, key=lambda p: p.expected_cost())
+
+def provider_image(result):
+    """A provider's return value as a file-like image or None; plain bytes are still accepted"""
+    if isinstance(result, (bytes, bytearray)):
+        return io.BytesIO(result) if result else None
+    if result is not None and not hasattr(result, "read"):
+        raise TypeError(f"expected a file-like image, bytes or None, got {type(result).__name__}")
+    return result
+
+def _call_provider(provider, prompt, trial=False):
+    started = time.monotonic()
+    image_data = None
+    with PROVIDER_IN_FLIGHT.track(provider=provider.name):
+        try:
+            image_data = provider_image(provider.generate(prompt))
+        except Exception as e:
+            logger.error(f"Error generating image with {provider.name}: {e}")
+    latency = time.monotonic() - started
+    provider.record(bool(image_data), latency, trial)
+    observe_provider_call(provider.name, image_data, latency)
+    return image_data
+
 def generate_image(prompt):
-    """Try multiple AI services to generate an image"""
+    """Generate an image with the fastest healthy provider, hedging to a second one if it is slow"""
     logger.info(f"Generating image for prompt: {prompt}")
     
-    # Try Stability AI first (if API key available)
-    if STABILITY_API_KEY:
-        logger.info("Trying Stability AI...")
-        image_data = generate_image_stability(prompt)
-        if image_data:
-            logger.info("Stability AI succeeded")
-            return image_data
-    
-    # Try Pollinations AI (free)
-    logger.info("Trying Pollinations AI...")
-    image_data = generate_image_pollinations(prompt)
-    if image_data:
-        logger.info("Pollinations AI succeeded")
-        return image_data
-    
-    # Try Hugging Face (free tier)
-    logger.info("Trying Hugging Face...")
-    image_data = generate_image_huggingface(prompt)
-    if image_data:
-        logger.info("Hugging Face succeeded")
-        return image_data
+    candidates = route_providers()
+    pending = {}
+    
+    def launch():
+        while candidates:
+            provider = candidates.pop(0)
+            trial = provider.begin()
+            if trial is None:
+                continue  # Another request took the half-open trial since routing
+            logger.info(f"Trying {provider.name}...")
+            pending[_provider_pool.submit(_call_provider, provider, prompt, trial)] = (provider, trial)
+            return
+    
+    if candidates:
+        launch()
+    
+    try:
+        while pending:
+            hedge = HEDGE_DELAY if candidates and HEDGE_DELAY > 0 else None
+            done, _ = wait(pending, timeout=hedge, return_when=FIRST_COMPLETED)
+            
+            if not done:
+                # Primary is slow: race the next provider against it
+                logger.info(f"No answer after {HEDGE_DELAY:.0f}s, hedging")
+                launch()
+                continue
+            
+            for future in done:
+                provider, _ = pending.pop(future)
+                image_data = future.result()
+                if image_data:
+                    logger.info(f"{provider.name} succeeded")
+                    return image_data
+            
+            # Everything in flight failed, fall through to the next provider
+            if not pending and candidates:
+                launch()
+    finally:
+        # Losers keep running in the pool (a blocking request cannot be
+        # interrupted) but their results are discarded
+        for future, (provider, trial) in pending.items():
+            if future.cancel():
+                # Never started, so _call_provider will not record it: release a half-open trial
+                provider.abandon(trial)
     
     logger.warning("All AI services failed")
     return None
 
+def provider_stats():
+    """Rolling latency, error rate and circuit state per provider"""
+    return {p.name: p.stats() for p in PROVIDERS}
+
+# Background provider health prober
+_probe_results = {}  # provider name -> latest probe result
+_probe_lock = threading.Lock()
+_prober = None
+
+def probe_providers():
+    """Probe every enabled provider once and store the results"""
+    for provider in PROVIDERS:
+        if not provider.is_enabled() or provider.probe is None:
+            continue
+        started = time.monotonic()
+        error = None
+        try:
+            reachable = bool(provider.probe())
+        except Exception as e:
+            reachable = False
+            error = str(e)
+        result = {
+            "reachable": reachable,
+            "probe_seconds": round(time.monotonic() - started, 3),
+            "checked_at": time.time(),
+            "error": error,
+        }
+        with _probe_lock:
+            _probe_results[provider.name] = result
+
+def _probe_loop():
+    while True:
+        try:
+            probe_providers()
+        except Exception as e:
+            logger.error(f"Provider probe failed: {e}")
+        time.sleep(PROVIDER_PROBE_INTERVAL)
+
+def start_prober():
+    """Start the background prober thread (once per process)"""
+    global _prober
+    if PROVIDER_PROBE_INTERVAL <= 0:
+        return
+    with _probe_lock:
+        if _prober is None or not _prober.is_alive():
+            _prober = threading.Thread(target=_probe_loop, name="imagify-prober", daemon=True)
+            _prober.start()
+
+def provider_health():
+    """Cached health per provider from the last probe and live traffic. Never calls a provider."""
+    start_prober()
+    health = {}
+    for provider in PROVIDERS:
+        entry = provider.stats()
+        with _probe_lock:
+            probe = _probe_results.get(provider.name)
+        entry.update(probe or {"reachable": None, "checked_at": None})
+        
+        if not entry["enabled"]:
+            entry["status"] = "disabled"
+        elif entry["reachable"] is False or entry["circuit"] == "open":
+            entry["status"] = "failing"
+        elif entry["reachable"] or entry["latency_seconds"] is not None:
+            entry["status"] = "ok"
+        else:
+            entry["status"] = "unknown"  # Not probed yet and no traffic
+        health[provider.name] = entry
+    return health
+
+PROVIDER_UP = Gauge(
+    "imagify_provider_up", "1 if the provider passed its last probe and its circuit is not open", ("provider",),
+    collect=lambda: {name: int(entry["status"] == "ok") for name, entry in provider_health().items()},
+)
+
+# Image post-processing (runs in a process pool so encoding does not hold the GIL)
+_postprocess_pool = None
+_postprocess_lock = threading.Lock()
+_postprocess_stats = {
+    "jobs": 0,
+    "skipped": 0,
+    "failed": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+    "encode_seconds": 0.0,
+}
+
+def _encode_image(source_path, target_path, output_format, quality, max_dimension, strip_metadata):
+    """Re-encode an image file into target_path (runs in a worker process). Returns (bytes written, format, size, seconds)."""
+    started = time.perf_counter()
+    img = Image.open(source_path)
+    source_format = (img.format or "png").lower()
+    target_format = source_format if output_format == "original" else output_format
+    
+    if max_dimension and max(img.size) > max_dimension:
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    
+    options = {}
+    if target_format in ("jpeg", "webp"):
+        options["quality"] = quality
+    if target_format == "jpeg":
+        options["optimize"] = True
+        if img.mode not in ("RGB", "L"):
+            # JPEG has no alpha channel: flatten onto white
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel("A"))
+    if not strip_metadata:
+        for key in ("exif", "icc_profile"):
+            if key in img.info:
+                options[key] = img.info[key]
+    
+    img.save(target_path, format=target_format.upper(), **options)
+    return os.path.getsize(target_path), target_format, img.size, time.perf_counter() - started
+
+def _get_postprocess_pool():
+    global _postprocess_pool
+    with _postprocess_lock:
+        if _postprocess_pool is None:
+            # spawn, not fork: forking a process full of threads can deadlock the child
+            _postprocess_pool = ProcessPoolExecutor(
+                max_workers=IMAGE_POSTPROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _postprocess_pool
+
+def _bump_postprocess_stat(name, amount=1):
+    with _postprocess_lock:
+        _postprocess_stats[name] += amount
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def start_postprocess(image):
+    """Spill a file-like image to disk and queue its re-encode. Returns (future, job), or None to send the image as is."""
+    if Image is None or IMAGE_POSTPROCESS_WORKERS <= 0:
+        _bump_postprocess_stat("skipped")
+        return None
+    
+    # The worker gets a path, not the bytes, so this process never holds the whole image
+    size_in = image_size(image)
+    image.seek(0)
+    source = None
+    try:
+        with tempfile.NamedTemporaryFile(prefix="imagify-", suffix=".in", delete=False) as source:
+            shutil.copyfileobj(image, source, STREAM_CHUNK_BYTES)
+        target = source.name[:-len(".in")] + ".out"
+        future = _get_postprocess_pool().submit(
+            _encode_image, source.name, target, IMAGE_OUTPUT_FORMAT, IMAGE_QUALITY, IMAGE_MAX_DIMENSION, IMAGE_STRIP_METADATA
+        )
+    except Exception as e:
+        logger.error(f"Error post-processing image: {e}")
+        _bump_postprocess_stat("failed")
+        if source is not None:
+            _remove_file(source.name)
+        image.seek(0)
+        return None
+    return future, (source.name, target, size_in)
+
+def finish_postprocess(image, job, result=None, error=None):
+    """Swap in the re-encoded image if it is smaller and clean up. Returns the image to send."""
+    source, target, size_in = job
+    _remove_file(source)
+    
+    if error is not None or result is None:
+        logger.error(f"Error post-processing image: {error}")
+        _bump_postprocess_stat("failed")
+        _remove_file(target)
+        image.seek(0)
+        return image
+    
+    size_out, image_format, (width, height), seconds = result
+    with _postprocess_lock:
+        _postprocess_stats["jobs"] += 1
+        _postprocess_stats["encode_seconds"] += seconds
+        _postprocess_stats["bytes_in"] += size_in
+        _postprocess_stats["bytes_out"] += min(size_out, size_in)
+    
+    if size_out >= size_in:
+        logger.info(f"Post-processing did not shrink the image ({size_in} bytes), sending original")
+        _remove_file(target)
+        image.seek(0)
+        return image
+    
+    logger.info(f"Post-processed image: {size_in} -> {size_out} bytes ({image_format}, {width}x{height}) in {seconds:.3f}s")
+    processed = open(target, "rb")
+    _remove_file(target)  # Stays readable through the open handle
+    image.close()
+    return processed
+
+def postprocess_image(image):
+    """Downscale, strip metadata and re-encode a file-like image. Returns the image to send."""
+    started = start_postprocess(image)
+    if started is None:
+        return image
+    
+    future, job = started
+    try:
+        result = future.result(timeout=PROVIDER_READ_TIMEOUT)
+    except Exception as e:
+        return finish_postprocess(image, job, error=e)
+    return finish_postprocess(image, job, result)
+
+def postprocess_stats():
+    """Snapshot of the post-processing counters"""
+    with _postprocess_lock:
+        stats = dict(_postprocess_stats)
+    stats["bytes_saved"] = stats["bytes_in"] - stats["bytes_out"]
+    stats["enabled"] = Image is not None and IMAGE_POSTPROCESS_WORKERS > 0
+    stats["output_format"] = IMAGE_OUTPUT_FORMAT
+    return stats
+
+# Prompt -> image cache
+_memory_cache = OrderedDict()  # key -> {"image": bytes or None if disk only, "file_id": str, "created": float}
+_cache_lock = threading.Lock()
+_cache_disk_bytes = 0  # Size of the disk tier when it was last measured
+_cache_stats = {
+    "memory_hits": 0,
+    "disk_hits": 0,
+    "file_id_hits": 0,
+    "misses": 0,
+    "memory_evictions": 0,
+    "disk_evictions": 0,
+    "expired": 0,
+}
+
+def normalize_prompt(prompt):
+    """Normalize a prompt so trivially different spellings share a cache entry"""
+    return " ".join(prompt.lower().split())
+
+def image_cache_key(prompt):
+    """Content address for a prompt plus every provider parameter that shapes the image"""
+    material = json.dumps(
+        {
+            "prompt": normalize_prompt(prompt),
+            "stability": STABILITY_PARAMS,
+            "huggingface": HUGGINGFACE_MODEL,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def _cache_paths(key):
+    return os.path.join(IMAGE_CACHE_DIR, f"{key}.img"), os.path.join(IMAGE_CACHE_DIR, f"{key}.json")
+
+def _write_atomic(path, data):
+    """Write bytes or a file-like object to path without exposing a partial file"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        if isinstance(data, bytes):
+            f.write(data)
+        else:
+            data.seek(0)
+            shutil.copyfileobj(data, f, STREAM_CHUNK_BYTES)
+    os.replace(tmp_path, path)
+
+def _remember_in_memory(key, entry):
+    """Insert into the LRU tier (caller holds _cache_lock)"""
+    _memory_cache[key] = entry
+    _memory_cache.move_to_end(key)
+    while len(_memory_cache) > IMAGE_CACHE_MEMORY_ITEMS:
+        _memory_cache.popitem(last=False)
+        _cache_stats["memory_evictions"] += 1
+
+def _scan_disk(now):
+    """Measure the disk tier and delete stale temp files (caller holds _cache_lock). Returns [(mtime, key), ...]."""
+    # Every process writing to IMAGE_CACHE_DIR counts, so the directory is measured rather than tracked
+    global _cache_disk_bytes
+    total = 0
+    images = []
+    for entry in os.scandir(IMAGE_CACHE_DIR):
+        try:
+            stat = entry.stat()
+            if entry.name.endswith(".tmp") and now - stat.st_mtime > IMAGE_CACHE_TMP_MAX_AGE:
+                os.remove(entry.path)
+                continue
+            total += stat.st_size
+            if entry.name.endswith(".img"):
+                images.append((stat.st_mtime, entry.name[:-4]))
+        except OSError:
+            pass
+    _cache_disk_bytes = total
+    return images
+
+def _remove_disk_entry(key):
+    """Delete a disk entry and return the bytes freed (caller holds _cache_lock)"""
+    global _cache_disk_bytes
+    freed = 0
+    for path in _cache_paths(key):
+        try:
+            freed += os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            pass
+    _cache_disk_bytes = max(0, _cache_disk_bytes - freed)
+    return freed
+
+def _evict_disk():
+    """Drop least recently used disk entries until under IMAGE_CACHE_DISK_BYTES (caller holds _cache_lock)"""
+    entries = _scan_disk(time.time())
+    for _, key in sorted(entries):
+        if _cache_disk_bytes <= IMAGE_CACHE_DISK_BYTES:
+            break
+        _remove_disk_entry(key)
+        _cache_stats["disk_evictions"] += 1
+
+def _load_disk_entry(key, now):
+    """Read a disk tier entry's metadata, and its image if small enough for memory (caller holds _cache_lock)"""
+    image_path, meta_path = _cache_paths(key)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if now - meta["created"] > IMAGE_CACHE_TTL:
+            _remove_disk_entry(key)
+            _cache_stats["expired"] += 1
+            return None
+        
+        image_data = None
+        if os.path.getsize(image_path) <= IMAGE_CACHE_MEMORY_ITEM_BYTES:
+            with open(image_path, "rb") as f:
+                image_data = f.read()
+        os.utime(image_path)  # Refresh LRU position for eviction
+        return {"image": image_data, "file_id": meta.get("file_id"), "created": meta["created"]}
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _open_cached_image(key, entry):
+    """File-like view of a cached image, or None if only the file_id survives"""
+    if entry["image"] is not None:
+        return io.BytesIO(entry["image"])
+    if IMAGE_CACHE_DIR:
+        try:
+            return open(_cache_paths(key)[0], "rb")
+        except OSError:
+            pass
+    return None
+
+def cache_get(key):
+    """Look up a cached image. Returns {"image": file-like|None, "file_id": str|None} or None."""
+    now = time.time()
+    with _cache_lock:
+        tier = "memory"
+        entry = _memory_cache.get(key)
+        if entry and now - entry["created"] > IMAGE_CACHE_TTL:
+            del _memory_cache[key]
+            _cache_stats["expired"] += 1
+            entry = None
+        
+        if entry:
+            _memory_cache.move_to_end(key)
+        elif IMAGE_CACHE_DIR:
+            tier = "disk"
+            entry = _load_disk_entry(key, now)
+            if entry:
+                _remember_in_memory(key, entry)
+        
+        image = _open_cached_image(key, entry) if entry else None
+        if image is None and not (entry and entry["file_id"]):
+            _cache_stats["misses"] += 1
+            return None
+        
+        _cache_stats["file_id_hits" if entry["file_id"] else f"{tier}_hits"] += 1
+        return {"image": image, "file_id": entry["file_id"]}
+
+def cache_put(key, image, file_id=None):
+    """Store a generated image (bytes or file-like) in both cache tiers"""
+    if isinstance(image, bytes):
+        image = io.BytesIO(image)
+    size = image_size(image)
+    
+    # Large images are only kept on disk so the memory tier stays bounded
+    image_data = None
+    if size <= IMAGE_CACHE_MEMORY_ITEM_BYTES:
+        image.seek(0)
+        image_data = image.read()
+    
+    entry = {"image": image_data, "file_id": file_id, "created": time.time()}
+    with _cache_lock:
+        _remember_in_memory(key, entry)
+        if not IMAGE_CACHE_DIR:
+            return
+        try:
+            os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+            _remove_disk_entry(key)
+            image_path, meta_path = _cache_paths(key)
+            meta = json.dumps({"created": entry["created"], "file_id": file_id}).encode("utf-8")
+            _write_atomic(image_path, image_data if image_data is not None else image)
+            _write_atomic(meta_path, meta)
+            _evict_disk()
+        except OSError as e:
+            logger.error(f"Error writing image cache: {e}")
+
+def cache_set_file_id(key, file_id):
+    """Remember the Telegram file_id of an uploaded cached image"""
+    with _cache_lock:
+        entry = _memory_cache.get(key)
+        if entry:
+            entry["file_id"] = file_id
+        if not IMAGE_CACHE_DIR:
+            return
+        _, meta_path = _cache_paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            meta["file_id"] = file_id
+            _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+        except (OSError, ValueError) as e:
+            logger.error(f"Error updating image cache: {e}")
+
+def cache_stats():
+    """Snapshot of the image cache counters"""
+    with _cache_lock:
+        stats = dict(_cache_stats)
+        stats["memory_items"] = len(_memory_cache)
+        stats["disk_bytes"] = _cache_disk_bytes
+    return stats
+
+START_MESSAGE = (
+    "👋 <b>Welcome to Imagify Bot!</b>\n\n"
+    "Send me any text prompt, and I'll generate an AI image for you 🎨✨\n\n"
+    "<i>Examples:</i>\n"
+    "• 'A cat wearing a space suit on Mars'\n"
+    "• 'A fantasy castle in the clouds'\n"
+    "• 'A robot painting a sunset'\n\n"
+    "✨ <b>Powered by multiple AI services for best results!</b>"
+)
+
 def handle_start_command(chat_id):
     """Handle /start command"""
-    message = (
-        "👋 <b>Welcome to Imagify Bot!</b>\n\n"
-        "Send me any text prompt, and I'll generate an AI image for you 🎨✨\n\n"
-        "<i>Examples:</i>\n"
-        "• 'A cat wearing a space suit on Mars'\n"
-        "• 'A fantasy castle in the clouds'\n"
-        "• 'A robot painting a sunset'\n\n"
-        "✨ <b>Powered by multiple AI services for best results!</b>"
+    send_telegram_message(chat_id, START_MESSAGE)
+
+def image_caption(prompt):
+    return f"✨ <b>Generated:</b> {prompt}\n\n🤖 <i>Made with AI</i>"
+
+def generation_failed_text(prompt):
+    return (
+        f"😔 Sorry, I couldn't generate an image for:\n<i>'{prompt}'</i>\n\n"
+        f"🔄 Please try:\n"
+        f"• A simpler prompt\n"
+        f"• Waiting a moment and trying again\n"
+        f"• Different wording\n\n"
+        f"💡 The AI services might be busy right now!"
     )
-    send_telegram_message(chat_id, message)
+
+def send_generation_failed(chat_id, prompt):
+    """All AI services failed - send a nice fallback message"""
+    send_telegram_message(chat_id, generation_failed_text(prompt))
+
+def send_image(chat_id, cache_key, image, caption):
+    """Upload a file-like image and remember its file_id. Returns the file_id (or None)."""
+    sent = send_telegram_photo(chat_id, image, caption)
+    
+    if not sent:
+        send_telegram_message(chat_id, "❌ Failed to send generated image. Please try again.")
+        return None
+    
+    file_id = photo_file_id(sent)
+    if file_id:
+        cache_set_file_id(cache_key, file_id)
+    return file_id
+
+# Single-flight: identical prompts in flight share one generation
+_inflight = {}  # cache key -> [(chat_id, prompt), ...] waiting on the leader
+_inflight_lock = threading.Lock()
+_singleflight_stats = {"generations": 0, "upstream_calls_saved": 0}
+
+def join_inflight(cache_key, chat_id, prompt):
+    """Join an in-flight generation of the same prompt. Returns False if the caller must generate it."""
+    with _inflight_lock:
+        if cache_key in _inflight:
+            _inflight[cache_key].append((chat_id, prompt))
+            _singleflight_stats["upstream_calls_saved"] += 1
+            return True
+        _inflight[cache_key] = []
+        _singleflight_stats["generations"] += 1
+        return False
+
+def finish_inflight(cache_key, image, file_id):
+    """Release an in-flight generation and deliver its result to every waiter"""
+    with _inflight_lock:
+        waiters = _inflight.pop(cache_key, [])
+    
+    for chat_id, prompt in waiters:
+        caption = image_caption(prompt)
+        try:
+            # Fan out by file_id: the image was uploaded once by the leader
+            if file_id and send_telegram_photo_url(chat_id, file_id, caption):
+                continue
+            if image:
+                file_id = send_image(chat_id, cache_key, image, caption) or file_id
+            else:
+                send_generation_failed(chat_id, prompt)
+        except Exception as e:
+            logger.error(f"Error delivering coalesced image to {chat_id}: {e}")
+
+def singleflight_stats():
+    with _inflight_lock:
+        stats = dict(_singleflight_stats)
+        stats["in_flight"] = len(_inflight)
+        stats["waiting"] = sum(len(waiters) for waiters in _inflight.values())
+    return stats
 
 def handle_text_message(chat_id, text):
     """Handle text message (image generation prompt)"""
     prompt = text.strip()
-    
-    # Send "generating" message
-    send_telegram_message(chat_id, "🎨 Generating your AI image... please wait ⏳")
+    caption = image_caption(prompt)
+    cache_key = image_cache_key(prompt)
     
     try:
-        # Try to generate image with multiple AI services
-        image_data = generate_image(prompt)
-        
-        if image_data:
-            # Send the generated image
-            success = send_telegram_photo(
-                chat_id, 
-                io.BytesIO(image_data), 
-                f"✨ <b>Generated:</b> {prompt}\n\n🤖 <i>Made with AI</i>"
-            )
+        cached = cache_get(cache_key)
+        if cached:
+            try:
+                # Already uploaded once: resend by file_id, no generation and no upload
+                if cached["file_id"] and send_telegram_photo_url(chat_id, cached["file_id"], caption):
+                    return
+                
+                if cached["image"]:
+                    send_image(chat_id, cache_key, cached["image"], caption)
+                    return
+            finally:
+                if cached["image"]:
+                    cached["image"].close()
+        
+        # Show "sending photo..." instead of a separate "generating" message
+        send_telegram_chat_action(chat_id)
+        
+        # Someone else is already generating this prompt; they will deliver it here
+        if join_inflight(cache_key, chat_id, prompt):
+            return
+        
+        image = None
+        file_id = None
+        try:
+            # Try to generate image with multiple AI services
+            image = generate_image(prompt)
             
-            if not success:
-                send_telegram_message(chat_id, "❌ Failed to send generated image. Please try again.")
-        else:
-            # All AI services failed - send a nice fallback message
-            send_telegram_message(
-                chat_id, 
-                f"😔 Sorry, I couldn't generate an image for:\n<i>'{prompt}'</i>\n\n"
-                f"🔄 Please try:\n"
-                f"• A simpler prompt\n"
-                f"• Waiting a moment and trying again\n"
-                f"• Different wording\n\n"
-                f"💡 The AI services might be busy right now!"
-            )
+            if image:
+                image = postprocess_image(image)
+                cache_put(cache_key, image)
+                file_id = send_image(chat_id, cache_key, image, caption)
+            else:
+                send_generation_failed(chat_id, prompt)
+        finally:
+            finish_inflight(cache_key, image, file_id)
+            if image:
+                image.close()
                 
     except Exception as e:
         logger.error(f"Error in handle_text_message: {e}")
         send_telegram_message(chat_id, "⚠️ Something went wrong while generating the image. Please try again!")
 
+# Background worker pool
+_job_queue = queue.Queue(maxsize=JOB_QUEUE_SIZE)
+_workers = []
+_workers_lock = threading.Lock()
+_queue_stats_lock = threading.Lock()
+_queue_stats = {
+    "enqueued": 0,
+    "rejected": 0,
+    "completed": 0,
+    "failed": 0,
+    "in_progress": 0,
+    "total_wait_seconds": 0.0,
+    "max_wait_seconds": 0.0,
+}
+
+def _bump_queue_stat(name, amount=1):
+    with _queue_stats_lock:
+        _queue_stats[name] += amount
+
+def _worker_loop():
+    """Run queued jobs until the process exits"""
+    while True:
+        func, args, enqueued_at = _job_queue.get()
+        wait = time.monotonic() - enqueued_at
+        with _queue_stats_lock:
+            _queue_stats["total_wait_seconds"] += wait
+            _queue_stats["max_wait_seconds"] = max(_queue_stats["max_wait_seconds"], wait)
+            _queue_stats["in_progress"] += 1
+        
+        try:
+            func(*args)
+            _bump_queue_stat("completed")
+        except Exception as e:
+            logger.error(f"Background job {func.__name__} failed: {e}")
+            _bump_queue_stat("failed")
+        finally:
+            _bump_queue_stat("in_progress", -1)
+            _job_queue.task_done()
+
+def start_workers():
+    """Start the background worker threads (once per process)"""
+    with _workers_lock:
+        # Threads do not survive a fork, so only count the live ones
+        _workers[:] = [t for t in _workers if t.is_alive()]
+        for i in range(len(_workers), WORKER_POOL_SIZE):
+            worker = threading.Thread(target=_worker_loop, name=f"imagify-worker-{i}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+def submit_job(func, *args):
+    """Queue a job for the worker pool. Returns False if the queue is full."""
+    if len(_workers) < WORKER_POOL_SIZE:
+        start_workers()
+    
+    try:
+        _job_queue.put_nowait((func, args, time.monotonic()))
+    except queue.Full:
+        _bump_queue_stat("rejected")
+        logger.warning(f"Job queue full ({JOB_QUEUE_SIZE}), rejecting {func.__name__}")
+        return False
+    
+    _bump_queue_stat("enqueued")
+    return True
+
+def queue_stats():
+    """Snapshot of the worker pool queue depth and wait times"""
+    with _queue_stats_lock:
+        stats = dict(_queue_stats)
+    
+    started = stats["completed"] + stats["failed"] + stats["in_progress"]
+    stats["depth"] = _job_queue.qsize()
+    stats["capacity"] = JOB_QUEUE_SIZE
+    stats["workers"] = WORKER_POOL_SIZE
+    stats["overflow_policy"] = QUEUE_OVERFLOW_POLICY
+    stats["avg_wait_seconds"] = stats["total_wait_seconds"] / started if started else 0.0
+    return stats
+
+JOBS_QUEUED = Gauge("imagify_jobs_queued", "Prompts waiting for a worker thread", collect=lambda: _job_queue.qsize())
+JOBS_IN_PROGRESS = Gauge("imagify_jobs_in_progress", "Prompts being handled by a worker thread", collect=lambda: queue_stats()["in_progress"])
+GENERATIONS_IN_FLIGHT = Gauge("imagify_generations_in_flight", "Distinct prompts being generated", collect=lambda: singleflight_stats()["in_flight"])
+TELEGRAM_OUTBOX = Gauge(
+    "imagify_telegram_outbox", "Telegram calls waiting to be sent",
+    collect=lambda: (lambda stats: stats["queued"] + stats["delayed"])(dispatcher_stats()),
+)
+
+# Duplicate update suppression: Telegram redelivers updates it thinks we missed
+class MemoryUpdateStore:
+    """Recently seen update_ids for this process only"""
+    
+    name = "memory"
+    
+    def __init__(self, window, max_items):
+        self.window = window
+        self.max_items = max_items
+        self.seen = OrderedDict()  # update_id -> seen at, oldest first
+        self.lock = threading.Lock()
+    
+    def add(self, update_id):
+        """Remember update_id. Returns False if it was already seen within the window."""
+        now = time.time()
+        with self.lock:
+            while self.seen and next(iter(self.seen.values())) < now - self.window:
+                self.seen.popitem(last=False)
+            if update_id in self.seen:
+                return False
+            self.seen[update_id] = now
+            while len(self.seen) > self.max_items:
+                self.seen.popitem(last=False)
+            return True
+    
+    def discard(self, update_id):
+        with self.lock:
+            self.seen.pop(update_id, None)
+    
+    def size(self):
+        with self.lock:
+            return len(self.seen)
+
+class SQLiteUpdateStore:
+    """Recently seen update_ids in a SQLite file shared by every worker on the box"""
+    
+    name = "sqlite"
+    PRUNE_EVERY = 1000  # Inserts between clean-ups
+    
+    def __init__(self, path, window, max_items):
+        self.path = path
+        self.window = window
+        self.max_items = max_items
+        self.local = threading.local()  # sqlite3 connections are per thread
+        self.inserts = 0
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY, seen_at REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS seen_updates_seen_at ON seen_updates (seen_at)")
+    
+    def _connect(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+    
+    def add(self, update_id):
+        """Remember update_id. Returns False if it was already seen within the window."""
+        now = time.time()
+        db = self._connect()
+        cursor = db.execute(
+            "INSERT INTO seen_updates (update_id, seen_at) VALUES (?, ?) "
+            "ON CONFLICT(update_id) DO UPDATE SET seen_at = excluded.seen_at WHERE seen_at < ?",
+            (update_id, now, now - self.window),
+        )
+        
+        self.inserts += 1
+        if self.inserts % self.PRUNE_EVERY == 0:
+            db.execute("DELETE FROM seen_updates WHERE seen_at < ?", (now - self.window,))
+            db.execute(
+                "DELETE FROM seen_updates WHERE update_id IN "
+                "(SELECT update_id FROM seen_updates ORDER BY seen_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_items,),
+            )
+        return cursor.rowcount == 1
+    
+    def discard(self, update_id):
+        self._connect().execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+    
+    def size(self):
+        return self._connect().execute("SELECT COUNT(*) FROM seen_updates").fetchone()[0]
+
+def _create_update_store():
+    if UPDATE_DEDUP_BACKEND == "sqlite":
+        return SQLiteUpdateStore(UPDATE_DEDUP_DB, UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_MAX)
+    return MemoryUpdateStore(UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_MAX)
+
+update_store = _create_update_store()
+_dedup_stats = {"duplicates_suppressed": 0}
+_dedup_lock = threading.Lock()
+
+def is_duplicate_update(update_id):
+    """Record update_id and say whether it was already handled"""
+    try:
+        if update_store.add(update_id):
+            return False
+    except sqlite3.Error as e:
+        # Better to risk a duplicate image than to drop the update
+        logger.error(f"Error checking update {update_id}: {e}")
+        return False
+    
+    with _dedup_lock:
+        _dedup_stats["duplicates_suppressed"] += 1
+    logger.info(f"Ignoring duplicate update {update_id}")
+    return True
+
+def forget_update(update_id):
+    """Let a redelivery of update_id through (e.g. after answering 503)"""
+    try:
+        update_store.discard(update_id)
+    except sqlite3.Error as e:
+        logger.error(f"Error forgetting update {update_id}: {e}")
+
+def dedup_stats():
+    with _dedup_lock:
+        stats = dict(_dedup_stats)
+    stats["backend"] = update_store.name
+    try:
+        stats["remembered"] = update_store.size()
+    except sqlite3.Error:
+        stats["remembered"] = None
+    return stats
+
+# Durable job store shared by intake and generate processes
+class SQLiteJobStore:
+    """Job table with leases; SQLite in WAL mode so several processes can share it"""
+    
+    name = "sqlite"
+    
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()  # sqlite3 connections are per thread
+        db = self._connect()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " chat_id INTEGER NOT NULL,"
+            " prompt TEXT NOT NULL,"
+            " state TEXT NOT NULL DEFAULT 'queued',"  # queued, leased, done, failed
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " lease_owner TEXT,"
+            " lease_expires REAL,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires)")
+    
+    def _connect(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+    
+    def enqueue(self, chat_id, prompt, max_queued):
+        """Add a job. Returns its id, or None if max_queued jobs are already waiting."""
+        db = self._connect()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            queued = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+            if queued >= max_queued:
+                db.execute("ROLLBACK")
+                return None
+            cursor = db.execute(
+                "INSERT INTO jobs (chat_id, prompt, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (chat_id, prompt, now, now),
+            )
+            db.execute("COMMIT")
+            return cursor.lastrowid
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    
+    def lease(self, owner, limit):
+        """Claim up to limit queued (or abandoned) jobs. Returns [(id, chat_id, prompt), ...]."""
+        db = self._connect()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Leases that ran out on their last attempt are given up on
+            db.execute(
+                "UPDATE jobs SET state = 'failed', updated_at = ? "
+                "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, JOB_MAX_ATTEMPTS),
+            )
+            rows = db.execute(
+                "SELECT id, chat_id, prompt FROM jobs "
+                "WHERE state = 'queued' OR (state = 'leased' AND lease_expires < ?) "
+                "ORDER BY id LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            if rows:
+                db.executemany(
+                    "UPDATE jobs SET state = 'leased', lease_owner = ?, lease_expires = ?, "
+                    "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    [(owner, now + JOB_LEASE_SECONDS, now, row[0]) for row in rows],
+                )
+            db.execute("COMMIT")
+            return rows
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    
+    def renew(self, owner):
+        """Extend the leases owner still holds. Returns how many were renewed."""
+        now = time.time()
+        cursor = self._connect().execute(
+            "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE state = 'leased' AND lease_owner = ?",
+            (now + JOB_LEASE_SECONDS, now, owner),
+        )
+        return cursor.rowcount
+    
+    def complete(self, job_id, owner, state="done"):
+        """Finish a job owner still holds. Returns False if its lease was lost to another process."""
+        cursor = self._connect().execute(
+            "UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ? "
+            "WHERE id = ? AND lease_owner = ? AND state = 'leased'",
+            (state, time.time(), job_id, owner),
+        )
+        return cursor.rowcount == 1
+    
+    def purge(self, older_than):
+        """Delete finished jobs last touched before older_than"""
+        self._connect().execute(
+            "DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?", (older_than,)
+        )
+    
+    def counts(self):
+        rows = self._connect().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return dict(rows)
+
+job_store = SQLiteJobStore(JOB_STORE_DB) if JOB_STORE == "sqlite" else None
+
+def dispatch_text(chat_id, text):
+    """Route a text message to the right handler"""
+    if text.startswith("/start"):
+        handle_start_command(chat_id)
+    else:
+        handle_text_message(chat_id, text)
+
+def enqueue_text(chat_id, text):
+    """Hand a text message to whichever job store is configured. Returns False if it is full."""
+    if job_store is None:
+        return submit_job(dispatch_text, chat_id, text)
+    
+    try:
+        job_id = job_store.enqueue(chat_id, text, JOB_QUEUE_SIZE)
+    except sqlite3.Error as e:
+        logger.error(f"Error storing job for chat {chat_id}: {e}")
+        return False
+    
+    if job_id is None:
+        _bump_queue_stat("rejected")
+        logger.warning(f"Job store full ({JOB_QUEUE_SIZE} queued), rejecting message from {chat_id}")
+        return False
+    _bump_queue_stat("enqueued")
+    return True
+
+def _run_stored_job(job_id, owner, chat_id, prompt):
+    try:
+        dispatch_text(chat_id, prompt)
+    finally:
+        if not job_store.complete(job_id, owner):
+            logger.warning(f"Job {job_id} finished after its lease was lost, another process may have run it too")
+
+def run_generate_worker():
+    """Lease jobs from the job store and run them on this process's worker pool"""
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    start_workers()
+    last_purge = last_renew = 0.0
+    logger.info(f"Generate worker {owner} leasing from {JOB_STORE_DB}")
+    
+    while True:
+        # Jobs still running keep their lease, so no other process starts them again
+        if time.time() - last_renew > JOB_LEASE_SECONDS / 3:
+            try:
+                job_store.renew(owner)
+                last_renew = time.time()
+            except sqlite3.Error as e:
+                logger.error(f"Error renewing job leases: {e}")
+        
+        # Only lease what the pool can start now so other workers get the rest
+        stats = queue_stats()
+        free = WORKER_POOL_SIZE - stats["in_progress"] - stats["depth"]
+        if free <= 0:
+            time.sleep(JOB_POLL_INTERVAL / 10)
+            continue
+        
+        try:
+            jobs = job_store.lease(owner, free)
+            if time.time() - last_purge > 3600:
+                job_store.purge(time.time() - 86400)
+                last_purge = time.time()
+        except sqlite3.Error as e:
+            logger.error(f"Error leasing jobs: {e}")
+            jobs = []
+        
+        if not jobs:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+        
+        for job_id, chat_id, prompt in jobs:
+            if not submit_job(_run_stored_job, job_id, owner, chat_id, prompt):
+                job_store.complete(job_id, owner, "queued")
+
+# Long-polling ingestion: getUpdates in batches, sharded by chat across processes
+def extract_text_message(update_data):
+    """(chat_id, text) of a text message update, or None"""
+    message = (update_data or {}).get("message") or {}
+    chat_id = message.get("chat", {}).get("id")
+    if not chat_id or "text" not in message:
+        return None
+    return chat_id, message["text"]
+
+def load_poll_offset():
+    try:
+        with open(POLL_OFFSET_FILE) as f:
+            return json.load(f)["offset"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_poll_offset(offset):
+    _write_atomic(POLL_OFFSET_FILE, json.dumps({"offset": offset}).encode("utf-8"))
+
+def _poll_lane(lane):
+    """Handle one lane's messages in arrival order"""
+    while True:
+        chat_id, text = lane.get()
+        try:
+            dispatch_text(chat_id, text)
+        except Exception as e:
+            logger.error(f"Error handling polled message from {chat_id}: {e}")
+
+def _exit_on_sigterm(signum, frame):
+    sys.exit(0)  # Runs finally blocks and atexit hooks, which stop child processes
+
+def _poll_shard_main(shard, inbox):
+    """Worker process: fan the shard's chats out over lanes, one chat always on the same lane"""
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    # The poller's share of the Telegram limit is split between its shard processes, burst included
+    global _global_bucket
+    shard_rate = TELEGRAM_PROCESS_RATE / POLL_WORKERS
+    _global_bucket = TokenBucket(shard_rate, max(1, int(shard_rate)))
+    lanes = [queue.Queue(maxsize=JOB_QUEUE_SIZE) for _ in range(WORKER_POOL_SIZE)]
+    for i, lane in enumerate(lanes):
+        threading.Thread(target=_poll_lane, args=(lane,), name=f"imagify-poll-{shard}-{i}", daemon=True).start()
+    
+    try:
+        while True:
+            chat_id, text = inbox.get()
+            lanes[(chat_id // POLL_WORKERS) % len(lanes)].put((chat_id, text))
+    finally:
+        # multiprocessing joins child processes on exit before executors are shut down, so stop the pool first
+        if _postprocess_pool is not None:
+            _postprocess_pool.shutdown(wait=True, cancel_futures=True)
+
+def run_poller():
+    """Pull updates with long-polling getUpdates and spread them over the shard processes"""
+    # getUpdates is refused while a webhook is set
+    http_request("POST", telegram_api_url("deleteWebhook"))
+    
+    context = multiprocessing.get_context("spawn")
+    inboxes = []
+    shards = []
+    if job_store is None:
+        for shard in range(POLL_WORKERS):
+            inboxes.append(context.Queue(maxsize=JOB_QUEUE_SIZE))
+            shards.append(None)
+    
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    try:
+        _poll_updates(context, shards, inboxes)
+    finally:
+        # Shards are not daemonic (a daemonic process may not start the post-processing pool), so stop them here
+        for process in shards:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in shards:
+            if process is not None:
+                process.join(10)
+
+def _start_shards(context, shards, inboxes):
+    """Start any shard process that is missing or died. A restarted shard gets a new, empty inbox."""
+    for shard, process in enumerate(shards):
+        if process is not None and process.is_alive():
+            continue
+        if process is not None:
+            # The dead process may have held the inbox's read lock, so the queue cannot be reused
+            logger.warning(f"Poll shard {shard} died (exit code {process.exitcode}), restarting it; its queued updates are lost")
+            inboxes[shard].cancel_join_thread()
+            inboxes[shard].close()
+            inboxes[shard] = context.Queue(maxsize=JOB_QUEUE_SIZE)
+        process = context.Process(target=_poll_shard_main, args=(shard, inboxes[shard]))
+        process.start()
+        shards[shard] = process
+
+def _send_to_shard(context, shards, inboxes, chat_id, text):
+    """Queue a message for the chat's shard, waiting while it is backed up and restarting it if it dies"""
+    shard = chat_id % POLL_WORKERS
+    while True:
+        try:
+            inboxes[shard].put((chat_id, text), timeout=JOB_POLL_INTERVAL)
+            return
+        except queue.Full:
+            _start_shards(context, shards, inboxes)
+
+def _poll_updates(context, shards, inboxes):
+    offset = load_poll_offset()
+    logger.info(f"Polling for updates from offset {offset}")
+    failures = 0
+    
+    while True:
+        _start_shards(context, shards, inboxes)
+        
+        try:
+            response = http_request(
+                "GET", telegram_api_url("getUpdates"),
+                read_timeout=POLL_TIMEOUT + HTTP_READ_TIMEOUT,
+                params={"offset": offset, "limit": POLL_BATCH, "timeout": POLL_TIMEOUT, "allowed_updates": '["message"]'},
+            )
+            result = response.json()
+            if not result.get("ok"):
+                raise ValueError(result.get("description", f"HTTP {response.status_code}"))
+            failures = 0
+        except Exception as e:
+            failures += 1
+            logger.error(f"Error polling updates: {e}")
+            time.sleep(min(30, 2 ** failures))
+            continue
+        
+        for update in result["result"]:
+            offset = max(offset or 0, update["update_id"] + 1)
+            if is_duplicate_update(update["update_id"]):
+                continue
+            parsed = extract_text_message(update)
+            if parsed is None:
+                continue
+            
+            chat_id, text = parsed
+            if job_store is not None:
+                # Durable mode: generate workers do the work
+                while not enqueue_text(chat_id, text):
+                    time.sleep(JOB_POLL_INTERVAL)
+            else:
+                # Waits while the shard is backed up, which slows polling down
+                _send_to_shard(context, shards, inboxes, chat_id, text)
+        
+        # Saved once the batch is queued, not handled: an update still queued in a shard when the
+        # poller or the shard dies is not fetched again (at-most-once), unlike with JOB_STORE=sqlite
+        if result["result"]:
+            save_poll_offset(offset)
+
 # Flask webhook endpoint
 @app.route("/webhook", methods=["POST"])
 def webhook():
     """Handle incoming webhooks from Telegram"""
+    started = time.monotonic()
+    with WEBHOOK_IN_FLIGHT.track():
+        response = accept_update()
+    WEBHOOK_SECONDS.observe(time.monotonic() - started, status=response[1])
+    TRANSFER_BYTES.inc(request.content_length or 0, direction="in", peer="webhook")
+    return response
+
+def accept_update():
+    """Deduplicate and enqueue one webhook update. Returns a Flask response tuple."""
     try:
         update_data = request.get_json()
         
         if not update_data:
             return "No data", 400
         
+        # Redelivered update we already accepted: acknowledge without doing any work
+        update_id = update_data.get("update_id")
+        if update_id is not None and is_duplicate_update(update_id):
+            return "OK", 200
+        
         # Extract message info
         message = update_data.get("message")
         if not message:
@@ -250,10 +2113,13 @@ def webhook():
         if "text" in message:
             text = message["text"]
             
-            if text.startswith("/start"):
-                handle_start_command(chat_id)
-            else:
-                handle_text_message(chat_id, text)
+            if not enqueue_text(chat_id, text):
+                if QUEUE_OVERFLOW_POLICY == "notify":
+                    send_telegram_message(chat_id, "🚦 I'm busy generating other images right now. Please try again in a minute!", wait=False)
+                    return "OK", 200
+                if update_id is not None:
+                    forget_update(update_id)
+                return "Busy", 503, {"Retry-After": "30"}
         
         return "OK", 200
         
@@ -261,6 +2127,17 @@ def webhook():
         logger.error(f"Webhook error: {e}")
         return "Error", 500
 
+HEALTH_ICONS = {"ok": "✅", "failing": "❌", "disabled": "⚠️", "unknown": "⏳"}
+SERVICE_TEST_KEYS = {"Stability AI": "stability_ai", "Pollinations AI": "pollinations", "Hugging Face": "hugging_face"}
+SERVICE_TEST_TEXT = {"ok": "✅ Working", "failing": "❌ Failed", "disabled": "⚠️ Disabled", "unknown": "⏳ Not checked yet"}
+
+def service_test_results():
+    """/test_services answer from the cached health snapshot"""
+    return {
+        SERVICE_TEST_KEYS.get(name, name.lower().replace(" ", "_")): SERVICE_TEST_TEXT[health["status"]]
+        for name, health in provider_health().items()
+    }
+
 @app.route("/", methods=["GET"])
 def health_check():
     status = "🤖 <b>Imagify Bot is running!</b><br><br>"
@@ -280,14 +2157,33 @@ def health_check():
     else:
         status += "ℹ️ Hugging Face API key missing (will use free tier)<br>"
     
-    status += "<br>🎨 <b>Available AI Services:</b><br>"
-    status += "• Stability AI (if key provided)<br>"
-    status += "• Pollinations.ai (free)<br>"
-    status += "• Hugging Face (free tier)<br>"
+    status += "<br>🎨 <b>AI Services:</b><br>"
+    for name, health in provider_health().items():
+        status += f"{HEALTH_ICONS[health['status']]} {name}: {health['status']}<br>"
     status += "<br>Send a message to the bot to start generating images!"
     
     return status, 200
 
+@app.route("/stats", methods=["GET"])
+def stats():
+    """Runtime statistics for the worker pool, connections, image cache and providers"""
+    return jsonify({
+        "queue": queue_stats(),
+        "http": http_stats(),
+        "cache": cache_stats(),
+        "providers": provider_health(),
+        "singleflight": singleflight_stats(),
+        "postprocess": postprocess_stats(),
+        "telegram": dispatcher_stats(),
+        "updates": dedup_stats(),
+        "jobs": job_store.counts() if job_store else None,
+    })
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus scrape endpoint (per process: each gunicorn worker reports its own numbers)"""
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.route("/set_webhook", methods=["GET"])
 def set_webhook():
     """Set webhook URL (call this once after deployment)"""
@@ -299,10 +2195,7 @@ def set_webhook():
     webhook_url = f"{app_url}/webhook"
     
     try:
-        response = requests.post(
-            f"https://api.telegram.org/bot{BOT_TOKEN}/setWebhook",
-            json={"url": webhook_url}
-        )
+        response = http_request("POST", telegram_api_url("setWebhook"), json={"url": webhook_url})
         
         if response.status_code == 200:
             result = response.json()
@@ -324,7 +2217,7 @@ def webhook_info():
         return "❌ BOT_TOKEN not configured", 500
         
     try:
-        response = requests.get(f"https://api.telegram.org/bot{BOT_TOKEN}/getWebhookInfo")
+        response = http_request("GET", telegram_api_url("getWebhookInfo"))
         
         if response.status_code == 200:
             return jsonify(response.json())
@@ -336,30 +2229,22 @@ def webhook_info():
 
 @app.route("/test_services", methods=["GET"])
 def test_services():
-    """Test all AI image generation services"""
-    results = {}
-    test_prompt = "a simple red apple"
-    
-    # Test Stability AI
-    if STABILITY_API_KEY:
-        stability_result = generate_image_stability(test_prompt)
-        results["stability_ai"] = "✅ Working" if stability_result else "❌ Failed"
-    else:
-        results["stability_ai"] = "⚠️ No API key"
-    
-    # Test Pollinations
-    pollinations_result = generate_image_pollinations(test_prompt)
-    results["pollinations"] = "✅ Working" if pollinations_result else "❌ Failed"
-    
-    # Test Hugging Face
-    hf_result = generate_image_huggingface(test_prompt)
-    results["hugging_face"] = "✅ Working" if hf_result else "❌ Failed"
-    
-    return jsonify(results)
+    """Status of all AI image generation services (from the background prober, no images are generated)"""
+    return jsonify(service_test_results())
 
 if __name__ == "__main__":
     if not BOT_TOKEN:
         print("❌ ERROR: Please set your BOT_TOKEN environment variable.")
+    elif sys.argv[1:2] == ["poll"]:
+        print("✅ Starting long-polling worker...")
+        run_poller()
+    elif sys.argv[1:2] == ["generate"]:
+        if job_store is None:
+            print("❌ ERROR: The generate worker needs JOB_STORE=sqlite.")
+            sys.exit(1)
+        else:
+            print("✅ Starting generate worker...")
+            run_generate_worker()
     else:
         print("✅ Starting webhook server...")
         app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=True)
\ No newline at end of file
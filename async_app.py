@@ -0,0 +1,687 @@
+import os
+import asyncio
+import functools
+import io
+import json
+import time
+from collections import OrderedDict
+from urllib.parse import quote
+
+import aiohttp
+from aiohttp import web
+
+# Configuration, the image cache, provider health and message texts are shared
+# with the Flask app so both serving modes behave the same way
+from app import (
+    BOT_TOKEN,
+    STABILITY_API_KEY,
+    HUGGINGFACE_API_KEY,
+    STABILITY_PARAMS,
+    HUGGINGFACE_MODEL,
+    HUGGINGFACE_API_BASE,
+    POLLINATIONS_API_BASE,
+    STABILITY_API_BASE,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    PROVIDER_READ_TIMEOUT,
+    HEDGE_DELAY,
+    MAX_IMAGE_BYTES,
+    STREAM_CHUNK_BYTES,
+    TELEGRAM_CHAT_BURST,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_PROCESS_RATE,
+    TELEGRAM_MAX_RETRIES,
+    QUEUE_OVERFLOW_POLICY,
+    START_MESSAGE,
+    cache_get,
+    cache_put,
+    cache_set_file_id,
+    cache_stats,
+    dedup_stats,
+    detect_image_format,
+    image_size,
+    enqueue_text,
+    forget_update,
+    generation_failed_text,
+    health_check as flask_health_check,
+    ImageSink,
+    image_cache_key,
+    image_caption,
+    is_duplicate_update,
+    job_store,
+    logger,
+    observe_provider_call,
+    observe_telegram_call,
+    photo_file_id,
+    finish_postprocess,
+    start_postprocess,
+    postprocess_stats,
+    provider_health,
+    provider_image,
+    PROVIDER_IN_FLIGHT,
+    render_metrics,
+    retry_after_seconds,
+    service_test_results,
+    TokenBucket,
+    route_providers,
+    telegram_api_url,
+    TELEGRAM_IN_FLIGHT,
+    TRANSFER_BYTES,
+    WEBHOOK_IN_FLIGHT,
+    WEBHOOK_SECONDS,
+)
+
+# Async serving settings
+ASYNC_HTTP_POOL_SIZE = int(os.getenv("ASYNC_HTTP_POOL_SIZE", "1000"))  # Total open connections
+ASYNC_MAX_CONCURRENCY = int(os.getenv("ASYNC_MAX_CONCURRENCY", "2000"))  # Prompts handled at once
+
+_session = None
+_tasks = set()  # Keeps references to background tasks so they are not garbage collected
+_inflight = {}  # cache key -> [(chat_id, prompt), ...] waiting on the leader
+_task_stats = {"accepted": 0, "rejected": 0, "generations": 0, "upstream_calls_saved": 0}
+
+# Telegram rate limiting (single event loop, so the buckets need no locks)
+_global_bucket = TokenBucket(TELEGRAM_PROCESS_RATE, max(1, int(TELEGRAM_PROCESS_RATE)))
+_chat_buckets = OrderedDict()  # chat_id -> TokenBucket, least recently used first
+_dispatch_stats = {"sent": 0, "throttled": 0, "retried": 0, "dropped": 0, "skipped_chat_actions": 0}
+
+async def http_request(method, url, read_timeout=None, **kwargs):
+    """Send a request through the shared aiohttp session. Returns (status, body bytes)."""
+    timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=read_timeout or HTTP_READ_TIMEOUT)
+    async with _session.request(method, url, timeout=timeout, **kwargs) as response:
+        return response.status, await response.read()
+
+async def http_image_request(method, url, read_timeout=None, base64_artifact=False, **kwargs):
+    """Stream a provider response into a spooled file. Returns (status, image or None, error body)."""
+    timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=read_timeout or HTTP_READ_TIMEOUT)
+    async with _session.request(method, url, timeout=timeout, **kwargs) as response:
+        if response.status != 200:
+            return response.status, None, await response.read()
+        
+        sink = ImageSink(base64_artifact)
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_BYTES):
+            if not sink.write(chunk):
+                logger.error(f"Image from {url} is larger than {MAX_IMAGE_BYTES} bytes, discarding")
+                sink.discard()
+                return response.status, None, b""
+        return response.status, sink.finish(), b""
+
+class ImageView(io.RawIOBase):
+    """Read-only view of an image file for one upload attempt.
+
+    aiohttp closes a file once it has sent it. Closing the view leaves the image
+    open for 429 retries, coalesced waiters and the caller's own close().
+    """
+
+    def __init__(self, image):
+        super().__init__()
+        self.image = image
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        self.image.seek(self.position)
+        data = self.image.read(len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += image_size(self.image)
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+class ImageViewPayload(aiohttp.payload.IOBasePayload):
+    """Upload payload for an ImageView with a known length, so the request keeps its Content-Length"""
+
+    def __init__(self, view, size, **kwargs):
+        super().__init__(view, **kwargs)
+        self._size = size
+
+    @property
+    def size(self):
+        return self._size
+
+def _chat_bucket(chat_id):
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _chat_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        while len(_chat_buckets) > 10000:
+            _chat_buckets.popitem(last=False)
+    _chat_buckets.move_to_end(chat_id)
+    return bucket
+
+async def telegram_call(chat_id, method, build_request, read_timeout=None):
+    """Rate-limited Telegram call that honours retry_after. Returns (status, body).
+
+    build_request() returns the request kwargs; it is called again on every retry
+    because an aiohttp FormData body can only be sent once.
+    """
+    chat_bucket = _chat_bucket(chat_id)
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        while True:
+            now = time.monotonic()
+            delay = max(_global_bucket.delay(now), chat_bucket.delay(now))
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        _global_bucket.take()
+        chat_bucket.take()
+
+        request_kwargs = build_request()
+        started = time.monotonic()
+        try:
+            with TELEGRAM_IN_FLIGHT.track():
+                status, body = await http_request("POST", telegram_api_url(method), read_timeout=read_timeout, **request_kwargs)
+        except Exception:
+            observe_telegram_call(method, "error", time.monotonic() - started)
+            raise
+        sent_bytes = len(json.dumps(request_kwargs["json"]).encode()) if "json" in request_kwargs else 0
+        observe_telegram_call(method, status, time.monotonic() - started, sent_bytes, len(body))
+        try:
+            retry_after = retry_after_seconds(status, json.loads(body) if status == 429 else None)
+        except ValueError:
+            retry_after = retry_after_seconds(status, None)
+        if retry_after is None:
+            _dispatch_stats["sent"] += 1
+            return status, body
+
+        _dispatch_stats["throttled"] += 1
+        chat_bucket.pause(retry_after)
+        if attempt < TELEGRAM_MAX_RETRIES:
+            _dispatch_stats["retried"] += 1
+            logger.info(f"Telegram asked to retry after {retry_after:.0f}s (chat {chat_id})")
+
+    _dispatch_stats["dropped"] += 1
+    logger.warning(f"Giving up on Telegram call for chat {chat_id} after {TELEGRAM_MAX_RETRIES} retries")
+    return status, body
+
+async def send_telegram_chat_action(chat_id, action="upload_photo"):
+    """Show a chat action; skipped when the chat has no spare capacity so real messages go first"""
+    if _chat_bucket(chat_id).delay(time.monotonic()) > 0:
+        _dispatch_stats["skipped_chat_actions"] += 1
+        return False
+    try:
+        status, _ = await telegram_call(chat_id, "sendChatAction", lambda: {"json": {"chat_id": chat_id, "action": action}})
+        return status == 200
+    except Exception as e:
+        logger.error(f"Error sending chat action: {e}")
+        return False
+
+async def send_telegram_message(chat_id, text):
+    """Send a text message via Telegram API"""
+    data = {
+        "chat_id": chat_id,
+        "text": text,
+        "parse_mode": "HTML"
+    }
+
+    try:
+        status, _ = await telegram_call(chat_id, "sendMessage", lambda: {"json": data})
+        return status == 200
+    except Exception as e:
+        logger.error(f"Error sending message: {e}")
+        return False
+
+async def send_telegram_photo(chat_id, photo_data, caption):
+    """Send a photo (file-like) via Telegram API. Returns the sent message on success, None on failure."""
+    image_format, mime_type = detect_image_format(photo_data)
+    # Measured up front: the image must not be touched once aiohttp has sent it
+    upload_size = image_size(photo_data)
+
+    def build_request():
+        # A fresh view per attempt: the previous one was closed by aiohttp
+        photo = ImageViewPayload(ImageView(photo_data), upload_size, content_type=mime_type)
+        form = aiohttp.FormData()
+        form.add_field("chat_id", str(chat_id))
+        form.add_field("caption", caption)
+        form.add_field("photo", photo, filename=f"image.{image_format}", content_type=mime_type)
+        return {"data": form}
+
+    try:
+        status, body = await telegram_call(chat_id, "sendPhoto", build_request, read_timeout=PROVIDER_READ_TIMEOUT)
+        if status != 200:
+            return None
+        # Multipart bodies have no length up front, so count the image itself
+        TRANSFER_BYTES.inc(upload_size, direction="out", peer="telegram")
+        return json.loads(body).get("result") or {"ok": True}
+    except Exception as e:
+        logger.error(f"Error sending photo: {e}")
+        return None
+
+async def send_telegram_photo_url(chat_id, photo_url, caption):
+    """Send a photo by URL (or by a Telegram file_id) via Telegram API"""
+    data = {
+        "chat_id": chat_id,
+        "photo": photo_url,
+        "caption": caption
+    }
+
+    try:
+        status, _ = await telegram_call(chat_id, "sendPhoto", lambda: {"json": data})
+        return status == 200
+    except Exception as e:
+        logger.error(f"Error sending photo URL: {e}")
+        return False
+
+async def generate_image_huggingface(prompt):
+    """Generate image using Hugging Face API (Free tier available)"""
+    try:
+        api_url = f"{HUGGINGFACE_API_BASE}/models/{HUGGINGFACE_MODEL}"
+
+        headers = {}
+        if HUGGINGFACE_API_KEY:
+            headers["Authorization"] = f"Bearer {HUGGINGFACE_API_KEY}"
+
+        status, image, body = await http_image_request("POST", api_url, read_timeout=PROVIDER_READ_TIMEOUT, headers=headers, json={"inputs": prompt})
+
+        if status == 200:
+            return image
+        logger.error(f"Hugging Face API error: {status} - {body[:500]!r}")
+        return None
+
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Error generating image with Hugging Face: {e}")
+        return None
+
+async def generate_image_stability(prompt):
+    """Generate image using Stability AI API"""
+    if not STABILITY_API_KEY:
+        return None
+
+    try:
+        url = f"{STABILITY_API_BASE}/v1/generation/stable-diffusion-v1-6/text-to-image"
+        headers = {"Authorization": f"Bearer {STABILITY_API_KEY}"}
+        data = {"text_prompts": [{"text": prompt}], **STABILITY_PARAMS}
+
+        status, image, body = await http_image_request(
+            "POST", url, read_timeout=PROVIDER_READ_TIMEOUT, base64_artifact=True, json=data, headers=headers
+        )
+
+        if status == 200:
+            return image
+        else:
+            logger.error(f"Stability AI API error: {status} - {body[:500]!r}")
+
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Error generating image with Stability: {e}")
+
+    return None
+
+async def generate_image_pollinations(prompt):
+    """Generate image using Pollinations AI (Free service)"""
+    try:
+        url = f"{POLLINATIONS_API_BASE}/prompt/{quote(prompt)}"
+        status, image, _ = await http_image_request("GET", url, read_timeout=PROVIDER_READ_TIMEOUT)
+
+        if status == 200:
+            return image
+        logger.error(f"Pollinations API error: {status}")
+        return None
+
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Error generating image with Pollinations: {e}")
+        return None
+
+# Native async versions of the registered providers. Providers registered
+# without one here still work; they run in a thread.
+ASYNC_BACKENDS = {
+    "Stability AI": generate_image_stability,
+    "Pollinations AI": generate_image_pollinations,
+    "Hugging Face": generate_image_huggingface,
+}
+
+async def _call_provider(provider, prompt, trial=False):
+    backend = ASYNC_BACKENDS.get(provider.name)
+    started = asyncio.get_running_loop().time()
+    image_data = None
+    with PROVIDER_IN_FLIGHT.track(provider=provider.name):
+        try:
+            if backend:
+                image_data = await backend(prompt)
+            else:
+                image_data = provider_image(await asyncio.to_thread(provider.generate, prompt))
+        except Exception as e:
+            logger.error(f"Error generating image with {provider.name}: {e}")
+    latency = asyncio.get_running_loop().time() - started
+    provider.record(bool(image_data), latency, trial)
+    observe_provider_call(provider.name, image_data, latency)
+    return image_data
+
+def _release_cancelled(provider, trial, task):
+    """A cancelled call records nothing, even if it was cancelled before it started"""
+    if task.cancelled():
+        provider.abandon(trial)
+
+async def generate_image(prompt):
+    """Generate an image with the fastest healthy provider, hedging to a second one if it is slow"""
+    logger.info(f"Generating image for prompt: {prompt}")
+
+    candidates = route_providers()
+    pending = {}
+
+    def launch():
+        while candidates:
+            provider = candidates.pop(0)
+            trial = provider.begin()
+            if trial is None:
+                continue  # Another request took the half-open trial since routing
+            logger.info(f"Trying {provider.name}...")
+            task = asyncio.create_task(_call_provider(provider, prompt, trial))
+            task.add_done_callback(functools.partial(_release_cancelled, provider, trial))
+            pending[task] = provider
+            return
+
+    if candidates:
+        launch()
+
+    try:
+        while pending:
+            hedge = HEDGE_DELAY if candidates and HEDGE_DELAY > 0 else None
+            done, _ = await asyncio.wait(pending, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                # Primary is slow: race the next provider against it
+                logger.info(f"No answer after {HEDGE_DELAY:.0f}s, hedging")
+                launch()
+                continue
+
+            for task in done:
+                provider = pending.pop(task)
+                image_data = task.result()
+                if image_data:
+                    logger.info(f"{provider.name} succeeded")
+                    return image_data
+
+            # Everything in flight failed, fall through to the next provider
+            if not pending and candidates:
+                launch()
+    finally:
+        # Unlike the threaded router, losing requests really are cancelled
+        for task in pending:
+            task.cancel()
+
+    logger.warning("All AI services failed")
+    return None
+
+async def postprocess_image(image):
+    """Re-encode an image on the process pool, awaiting the result without holding an executor thread"""
+    started = await asyncio.to_thread(start_postprocess, image)
+    if started is None:
+        return image
+
+    future, job = started
+    try:
+        result = await asyncio.wait_for(asyncio.wrap_future(future), PROVIDER_READ_TIMEOUT)
+    except asyncio.CancelledError:
+        await asyncio.to_thread(finish_postprocess, image, job, error="cancelled")
+        raise
+    except Exception as e:
+        return await asyncio.to_thread(finish_postprocess, image, job, error=e)
+    return await asyncio.to_thread(finish_postprocess, image, job, result)
+
+async def send_image(chat_id, cache_key, image, caption):
+    """Upload a file-like image and remember its file_id. Returns the file_id (or None)."""
+    sent = await send_telegram_photo(chat_id, image, caption)
+
+    if not sent:
+        await send_telegram_message(chat_id, "❌ Failed to send generated image. Please try again.")
+        return None
+
+    file_id = photo_file_id(sent)
+    if file_id:
+        await asyncio.to_thread(cache_set_file_id, cache_key, file_id)
+    return file_id
+
+async def finish_inflight(cache_key, image, file_id):
+    """Release an in-flight generation and deliver its result to every waiter"""
+    for chat_id, prompt in _inflight.pop(cache_key, []):
+        caption = image_caption(prompt)
+        try:
+            if file_id and await send_telegram_photo_url(chat_id, file_id, caption):
+                continue
+            if image:
+                file_id = await send_image(chat_id, cache_key, image, caption) or file_id
+            else:
+                await send_telegram_message(chat_id, generation_failed_text(prompt))
+        except Exception as e:
+            logger.error(f"Error delivering coalesced image to {chat_id}: {e}")
+
+async def handle_start_command(chat_id):
+    """Handle /start command"""
+    await send_telegram_message(chat_id, START_MESSAGE)
+
+async def handle_text_message(chat_id, text):
+    """Handle text message (image generation prompt)"""
+    prompt = text.strip()
+    caption = image_caption(prompt)
+    cache_key = image_cache_key(prompt)
+
+    try:
+        cached = await asyncio.to_thread(cache_get, cache_key)
+        if cached:
+            try:
+                # Already uploaded once: resend by file_id, no generation and no upload
+                if cached["file_id"] and await send_telegram_photo_url(chat_id, cached["file_id"], caption):
+                    return
+
+                if cached["image"]:
+                    await send_image(chat_id, cache_key, cached["image"], caption)
+                    return
+            finally:
+                if cached["image"]:
+                    cached["image"].close()
+
+        # Show "sending photo..." instead of a separate "generating" message
+        spawn(send_telegram_chat_action(chat_id))
+
+        # Someone else is already generating this prompt; they will deliver it here
+        if cache_key in _inflight:
+            _inflight[cache_key].append((chat_id, prompt))
+            _task_stats["upstream_calls_saved"] += 1
+            return
+        _inflight[cache_key] = []
+        _task_stats["generations"] += 1
+
+        image = None
+        file_id = None
+        try:
+            image = await generate_image(prompt)
+
+            if image:
+                image = await postprocess_image(image)
+                await asyncio.to_thread(cache_put, cache_key, image)
+                file_id = await send_image(chat_id, cache_key, image, caption)
+            else:
+                await send_telegram_message(chat_id, generation_failed_text(prompt))
+        finally:
+            await finish_inflight(cache_key, image, file_id)
+            if image:
+                image.close()
+
+    except Exception as e:
+        logger.error(f"Error in handle_text_message: {e}")
+        await send_telegram_message(chat_id, "⚠️ Something went wrong while generating the image. Please try again!")
+
+def spawn(coro):
+    """Run a handler in the background, keeping a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+async def webhook(request):
+    """Handle incoming webhooks from Telegram"""
+    started = time.monotonic()
+    with WEBHOOK_IN_FLIGHT.track():
+        response = await accept_update(request)
+    WEBHOOK_SECONDS.observe(time.monotonic() - started, status=response.status)
+    TRANSFER_BYTES.inc(request.content_length or 0, direction="in", peer="webhook")
+    return response
+
+async def accept_update(request):
+    """Deduplicate and enqueue (or start) one webhook update"""
+    try:
+        update_data = await request.json()
+    except Exception:
+        update_data = None
+
+    try:
+        if not update_data:
+            return web.Response(text="No data", status=400)
+
+        # Redelivered update we already accepted: acknowledge without doing any work
+        update_id = update_data.get("update_id")
+        if update_id is not None and await asyncio.to_thread(is_duplicate_update, update_id):
+            return web.Response(text="OK")
+
+        message = update_data.get("message")
+        if not message:
+            return web.Response(text="No message", status=400)
+
+        chat_id = message.get("chat", {}).get("id")
+        if not chat_id:
+            return web.Response(text="No chat ID", status=400)
+
+        if "text" in message:
+            text = message["text"]
+
+            if job_store is not None:
+                # Durable mode: generate workers pick it up from the job table
+                accepted = await asyncio.to_thread(enqueue_text, chat_id, text)
+            else:
+                accepted = len(_tasks) < ASYNC_MAX_CONCURRENCY
+
+            if not accepted:
+                _task_stats["rejected"] += 1
+                if QUEUE_OVERFLOW_POLICY == "notify":
+                    spawn(send_telegram_message(chat_id, "🚦 I'm busy generating other images right now. Please try again in a minute!"))
+                    return web.Response(text="OK")
+                if update_id is not None:
+                    await asyncio.to_thread(forget_update, update_id)
+                return web.Response(text="Busy", status=503, headers={"Retry-After": "30"})
+
+            _task_stats["accepted"] += 1
+            if job_store is None:
+                if text.startswith("/start"):
+                    spawn(handle_start_command(chat_id))
+                else:
+                    spawn(handle_text_message(chat_id, text))
+
+        return web.Response(text="OK")
+
+    except Exception as e:
+        logger.error(f"Webhook error: {e}")
+        return web.Response(text="Error", status=500)
+
+async def health_check(request):
+    status, code = flask_health_check()
+    return web.Response(text=status, status=code, content_type="text/html")
+
+async def stats(request):
+    """Runtime statistics for the async server, image cache and providers"""
+    tasks = dict(_task_stats)
+    tasks["running"] = len(_tasks)
+    tasks["limit"] = ASYNC_MAX_CONCURRENCY
+    tasks["in_flight_prompts"] = len(_inflight)
+    return web.json_response({
+        "tasks": tasks,
+        "cache": await asyncio.to_thread(cache_stats),
+        "providers": await asyncio.to_thread(provider_health),
+        "postprocess": postprocess_stats(),
+        "telegram": dict(_dispatch_stats, chats_tracked=len(_chat_buckets)),
+        "updates": await asyncio.to_thread(dedup_stats),
+        "jobs": await asyncio.to_thread(job_store.counts) if job_store else None,
+    })
+
+async def set_webhook(request):
+    """Set webhook URL (call this once after deployment)"""
+    if not BOT_TOKEN:
+        return web.Response(text="❌ BOT_TOKEN not configured", status=500)
+
+    webhook_url = f"{request.scheme}://{request.host}/webhook"
+
+    try:
+        status, body = await http_request("POST", telegram_api_url("setWebhook"), json={"url": webhook_url})
+
+        if status == 200:
+            result = json.loads(body)
+            if result.get("ok"):
+                return web.Response(text=f"✅ Webhook set successfully to {webhook_url}")
+            return web.Response(text=f"❌ Failed to set webhook: {result.get('description', 'Unknown error')}", status=500)
+        return web.Response(text=f"❌ HTTP Error: {status} - {body.decode(errors='replace')}", status=500)
+
+    except Exception as e:
+        logger.error(f"Error setting webhook: {e}")
+        return web.Response(text=f"❌ Error setting webhook: {str(e)}", status=500)
+
+async def webhook_info(request):
+    """Get current webhook information"""
+    if not BOT_TOKEN:
+        return web.Response(text="❌ BOT_TOKEN not configured", status=500)
+
+    try:
+        status, body = await http_request("GET", telegram_api_url("getWebhookInfo"))
+
+        if status == 200:
+            return web.json_response(json.loads(body))
+        return web.Response(text=f"❌ Error: {status} - {body.decode(errors='replace')}", status=500)
+
+    except Exception as e:
+        return web.Response(text=f"❌ Error getting webhook info: {str(e)}", status=500)
+
+async def test_services(request):
+    """Status of all AI image generation services (from the background prober, no images are generated)"""
+    return web.json_response(await asyncio.to_thread(service_test_results))
+
+async def metrics(request):
+    """Prometheus scrape endpoint (shares the registry with the threads of this process)"""
+    return web.Response(text=await asyncio.to_thread(render_metrics), content_type="text/plain", charset="utf-8")
+
+async def _open_session(application):
+    global _session
+    _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ASYNC_HTTP_POOL_SIZE))
+
+async def _close_session(application):
+    # Let running generations finish before the session goes away
+    if _tasks:
+        await asyncio.gather(*_tasks, return_exceptions=True)
+    await _session.close()
+
+async def create_app():
+    """aiohttp application factory (gunicorn async_app:create_app --worker-class aiohttp.GunicornWebWorker)"""
+    application = web.Application()
+    application.router.add_post("/webhook", webhook)
+    application.router.add_get("/", health_check)
+    application.router.add_get("/stats", stats)
+    application.router.add_get("/metrics", metrics)
+    application.router.add_get("/set_webhook", set_webhook)
+    application.router.add_get("/webhook_info", webhook_info)
+    application.router.add_get("/test_services", test_services)
+    application.on_startup.append(_open_session)
+    application.on_cleanup.append(_close_session)
+    return application
+
+if __name__ == "__main__":
+    if not BOT_TOKEN:
+        print("❌ ERROR: Please set your BOT_TOKEN environment variable.")
+    else:
+        print("✅ Starting async webhook server...")
+        web.run_app(create_app(), host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,399 @@
+"""End-to-end load test: drive /webhook at a target rate against local stand-ins.
+
+Starts mock Telegram, Stability, Pollinations and Hugging Face servers
+(benchmarks/mock_services.py), starts the bot pointed at them and posts
+synthetic updates to /webhook at --rate per second. Every update comes from a
+new chat, so end-to-end latency is measured from when an update was due to be
+sent until the mock Telegram receives that chat's photo or failure message.
+Every chat should get exactly one reply: chats that got several, or a message
+after their photo (e.g. "Failed to send generated image" after a successful
+upload), are reported as problems and fail the run with --fail-on-regression.
+
+    python benchmarks/bench_load.py --server gunicorn --workers 2 --threads 8 --rate 20 --duration 30
+    python benchmarks/bench_load.py --server async --rate 50 --latency stability=fixed:1 --error-rate huggingface=0.3
+    python benchmarks/bench_load.py --rate-limit telegram=0.05 --env TELEGRAM_GLOBAL_RATE=100
+
+Results are saved as JSON in benchmarks/results/ together with the git commit,
+and compared with the previous run of the same scenario.
+"""
+import argparse
+import glob
+import importlib.util
+import json
+import math
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from mock_services import DEFAULT_LATENCY, SERVICES, service_env, start_mock_services, stop_mock_services
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+REPLY_SETTLE_SECONDS = 2.0  # How long to keep listening for extra replies once every chat has one
+
+# Metrics compared between runs: name -> True if higher is better
+COMPARED = {
+    "throughput_per_second": True,
+    "e2e_p50_seconds": False,
+    "e2e_p95_seconds": False,
+    "e2e_p99_seconds": False,
+    "webhook_p99_ms": False,
+    "delivered": True,
+    "peak_rss_mib": False,
+    "connections_opened": False,
+}
+
+def service_values(pairs, option, cast=float):
+    """Parse repeated SERVICE=VALUE options"""
+    values = {}
+    for pair in pairs or []:
+        service, _, value = pair.partition("=")
+        if service not in SERVICES or not value:
+            raise SystemExit(f"{option} expects SERVICE=VALUE with SERVICE one of {', '.join(SERVICES)}, got {pair!r}")
+        values[service] = cast(value)
+    return values
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def server_command(args, port):
+    if args.server == "gunicorn":
+        return [
+            sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{port}",
+            "--workers", str(args.workers), "--threads", str(args.threads),
+        ]
+    if args.server == "flask":
+        return [sys.executable, "-m", "flask", "--app", "app", "run", "--host", "127.0.0.1", "--port", str(port), "--no-reload", "--no-debugger"]
+    return [sys.executable, "async_app.py"]
+
+def start_bot(args, port, services, workdir):
+    """Start the bot under test and wait until it answers"""
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": "bench",
+        "STABILITY_API_KEY": "bench",
+        "PORT": str(port),
+        "IMAGE_CACHE_DIR": os.path.join(workdir, "cache"),
+        "UPDATE_DEDUP_DB": os.path.join(workdir, "updates.sqlite3"),
+        "JOB_STORE_DB": os.path.join(workdir, "jobs.sqlite3"),
+        "POLL_OFFSET_FILE": os.path.join(workdir, "poll_offset.json"),
+    })
+    if args.server == "gunicorn":
+        env["WEB_CONCURRENCY"] = str(args.workers)  # Splits the Telegram rate limit between the workers
+    env.update(service_env(services))
+    env.update(args.env)
+
+    log = open(os.path.join(workdir, "bot.log"), "wb")
+    process = subprocess.Popen(server_command(args, port), cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                # Same call a deployment makes once; answered by the mock Telegram
+                requests.get(f"http://127.0.0.1:{port}/set_webhook", timeout=10)
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+
+    process.kill()
+    log.close()
+    with open(log.name, errors="replace") as f:
+        sys.stderr.write(f.read()[-4000:])
+    raise SystemExit(f"Bot did not start ({' '.join(server_command(args, port))})")
+
+def stop_bot(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def process_tree(pid):
+    """pid and all of its descendants"""
+    parents = {}
+    for stat_path in glob.glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat_path) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        parents.setdefault(int(fields[1]), []).append(int(stat_path.split("/")[2]))
+
+    tree, todo = [], [pid]
+    while todo:
+        current = todo.pop()
+        tree.append(current)
+        todo.extend(parents.get(current, []))
+    return tree
+
+def peak_rss_kib(pid):
+    """Sum of VmHWM (peak resident set) over the bot's process tree, in KiB"""
+    total = 0
+    for child in process_tree(pid):
+        try:
+            with open(f"/proc/{child}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total
+
+def drive(url, rate, duration, prompts, concurrency, first_id):
+    """Post synthetic updates at a fixed rate (open loop). Returns (start, [(due, status, seconds), ...])."""
+    total = max(1, int(rate * duration))
+    results = [None] * total
+    local = threading.local()
+    start = time.monotonic() + 0.5
+
+    def send(i):
+        due = start + i / rate
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        chat_id = first_id + i
+        update = {
+            "update_id": first_id + i,
+            "message": {
+                "message_id": i + 1,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                "text": f"benchmark prompt {i % prompts if prompts else i}",
+            },
+        }
+        started = time.monotonic()
+        try:
+            status = local.session.post(url, json=update, timeout=30).status_code
+        except requests.RequestException:
+            status = "error"
+        results[i] = (due, status, time.monotonic() - started)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(total)))
+    return start, results
+
+def percentile(values, fraction):
+    """Nearest-rank percentile, None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+def summarize(start, sent, deliveries, first_id, services, rss_kib):
+    statuses = {}
+    for _, status, _ in sent:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    webhook_ms = [seconds * 1000 for _, _, seconds in sent]
+    e2e, kinds, last = [], {"photo": 0, "message": 0}, start
+    repeated, failed_after_photo = [], []
+    for i, (due, status, _) in enumerate(sent):
+        replies = deliveries.get(first_id + i)
+        if not replies:
+            continue
+        first_time, first_kind = replies[0]
+        e2e.append(first_time - due)
+        kinds[first_kind] += 1
+        last = max(last, first_time)
+        if len(replies) > 1:
+            repeated.append(first_id + i)
+        if first_kind == "photo" and any(kind == "message" for _, kind in replies[1:]):
+            failed_after_photo.append(first_id + i)
+
+    delivered = len(e2e)
+    return {
+        "sent": len(sent),
+        "webhook_status": statuses,
+        "webhook_p50_ms": percentile(webhook_ms, 0.50),
+        "webhook_p95_ms": percentile(webhook_ms, 0.95),
+        "webhook_p99_ms": percentile(webhook_ms, 0.99),
+        "delivered": delivered,
+        "delivered_photos": kinds["photo"],
+        "delivered_failure_messages": kinds["message"],
+        "chats_with_several_replies": len(repeated),
+        "chats_with_message_after_photo": len(failed_after_photo),
+        "problem_chats": sorted(set(repeated + failed_after_photo))[:20],
+        "throughput_per_second": delivered / (last - start) if delivered and last > start else 0.0,
+        "e2e_p50_seconds": percentile(e2e, 0.50),
+        "e2e_p95_seconds": percentile(e2e, 0.95),
+        "e2e_p99_seconds": percentile(e2e, 0.99),
+        "peak_rss_mib": rss_kib / 1024,
+        "connections_opened": sum(server.stats()["connections"] for server in services.values()),
+        "services": {name: server.stats() for name, server in services.items()},
+    }
+
+def version_info():
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip()
+        except (OSError, subprocess.TimeoutExpired):
+            return ""
+    return {
+        "commit": git("rev-parse", "--short", "HEAD") or None,
+        "subject": git("log", "-1", "--format=%s") or None,
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+def previous_run(results_dir, scenario):
+    """The newest saved result with the same scenario, or None"""
+    for path in sorted(glob.glob(os.path.join(results_dir, "*.json")), reverse=True):
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if saved.get("scenario") == scenario:
+            return path, saved
+    return None
+
+def compare(previous, current, tolerance):
+    """Print metric changes against a previous run. Returns the names of regressed metrics."""
+    regressed = []
+    print(f"\n{'metric':<24}{'previous':>12}{'current':>12}{'change':>10}")
+    for name, higher_is_better in COMPARED.items():
+        old, new = previous.get(name), current.get(name)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = change < -tolerance if higher_is_better else change > tolerance
+        if worse:
+            regressed.append(name)
+        print(f"{name:<24}{old:>12.3f}{new:>12.3f}{change:>+9.1%}{'  REGRESSION' if worse else ''}")
+    return regressed
+
+def print_report(results):
+    def fmt(value, unit=""):
+        return "n/a" if value is None else f"{value:.3f}{unit}"
+
+    print(f"sent {results['sent']} updates, webhook responses {results['webhook_status']}")
+    print(f"webhook intake   p50 {fmt(results['webhook_p50_ms'], ' ms')}  p95 {fmt(results['webhook_p95_ms'], ' ms')}  p99 {fmt(results['webhook_p99_ms'], ' ms')}")
+    print(f"delivered        {results['delivered']} ({results['delivered_photos']} photos, {results['delivered_failure_messages']} failure messages)")
+    if results["chats_with_several_replies"] or results["chats_with_message_after_photo"]:
+        print(f"PROBLEM          {results['chats_with_several_replies']} chats got more than one reply, "
+              f"{results['chats_with_message_after_photo']} got a message after their photo (e.g. chats {results['problem_chats']})")
+    print(f"throughput       {results['throughput_per_second']:.2f} deliveries/s")
+    print(f"end-to-end       p50 {fmt(results['e2e_p50_seconds'], ' s')}  p95 {fmt(results['e2e_p95_seconds'], ' s')}  p99 {fmt(results['e2e_p99_seconds'], ' s')}")
+    print(f"peak RSS         {results['peak_rss_mib']:.1f} MiB (bot process tree)")
+    print(f"connections      {results['connections_opened']} opened to the stand-ins")
+    for name, stats in results["services"].items():
+        print(f"  {name:<14}{stats['connections']:>6} connections {stats['requests']:>7} calls {stats['errors']:>5} errors {stats['throttled']:>5} 429s")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=("gunicorn", "flask", "async"), default="gunicorn", help="how the bot is served")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--rate", type=float, default=10, help="updates per second sent to /webhook")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to keep sending")
+    parser.add_argument("--drain", type=float, default=120, help="seconds to wait for outstanding replies afterwards")
+    parser.add_argument("--prompts", type=int, default=0, help="distinct prompts to cycle through (0: every prompt is new)")
+    parser.add_argument("--concurrency", type=int, default=64, help="client threads posting updates")
+    parser.add_argument("--latency", action="append", metavar="SERVICE=DIST",
+                        help="fixed:S, uniform:LOW,HIGH, normal:MEAN,SD or lognormal:MEDIAN,SIGMA in seconds "
+                             f"(defaults: {', '.join(f'{k}={v}' for k, v in DEFAULT_LATENCY.items())})")
+    parser.add_argument("--error-rate", action="append", metavar="SERVICE=P", help="fraction of calls answered with a 500")
+    parser.add_argument("--rate-limit", action="append", metavar="SERVICE=P", help="fraction of calls answered with a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after sent with Telegram 429s")
+    parser.add_argument("--image-px", type=int, default=512, help="side of the square PNG the providers return")
+    parser.add_argument("--env", action="append", metavar="KEY=VALUE", default=[], help="extra environment for the bot (e.g. WORKER_POOL_SIZE=16)")
+    parser.add_argument("--label", default="", help="name for the result file")
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("--tolerance", type=float, default=0.10, help="relative change counted as a regression")
+    parser.add_argument("--no-save", action="store_true", help="do not write a result file")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 if a metric regressed")
+    args = parser.parse_args()
+
+    latency = service_values(args.latency, "--latency", str)
+    error_rate = service_values(args.error_rate, "--error-rate")
+    rate_limit = service_values(args.rate_limit, "--rate-limit")
+    args.env = dict(pair.partition("=")[::2] for pair in args.env)
+    if args.server == "gunicorn" and importlib.util.find_spec("gunicorn") is None:
+        parser.error("gunicorn is not installed; use --server flask or --server async")
+
+    scenario = {
+        "server": args.server,
+        "workers": args.workers if args.server == "gunicorn" else None,
+        "threads": args.threads if args.server == "gunicorn" else None,
+        "rate": args.rate,
+        "duration": args.duration,
+        "prompts": args.prompts,
+        "latency": dict(DEFAULT_LATENCY, **latency),
+        "error_rate": error_rate,
+        "rate_limit": rate_limit,
+        "retry_after": args.retry_after,
+        "image_px": args.image_px,
+        "env": args.env,
+    }
+
+    services = start_mock_services(latency, error_rate, rate_limit, args.retry_after, args.image_px)
+    workdir = tempfile.mkdtemp(prefix="imagify-bench-")
+    port = free_port()
+    bot = start_bot(args, port, services, workdir)
+    first_id = int(time.time())  # Fresh update_ids and chat ids for every run
+
+    try:
+        print(f"driving http://127.0.0.1:{port}/webhook at {args.rate:g}/s for {args.duration:g}s ({args.server})")
+        start, sent = drive(f"http://127.0.0.1:{port}/webhook", args.rate, args.duration, args.prompts, args.concurrency, first_id)
+
+        expected = {first_id + i for i, (_, status, _) in enumerate(sent) if status == 200}
+        deadline = time.monotonic() + args.drain
+        telegram = services["telegram"]
+        while time.monotonic() < deadline:
+            with telegram.lock:
+                if expected.issubset(telegram.deliveries):
+                    break
+            time.sleep(0.25)
+        time.sleep(REPLY_SETTLE_SECONDS)  # Let a follow-up to the last replies arrive too
+        with telegram.lock:
+            deliveries = {chat_id: list(replies) for chat_id, replies in telegram.deliveries.items()}
+
+        results = summarize(start, sent, deliveries, first_id, services, peak_rss_kib(bot.pid))
+    finally:
+        stop_bot(bot)
+        stop_mock_services(services)
+
+    print_report(results)
+    print(f"bot log: {os.path.join(workdir, 'bot.log')}")
+
+    regressed = [name for name in ("chats_with_several_replies", "chats_with_message_after_photo") if results[name]]
+    previous = previous_run(args.results_dir, scenario)
+    if previous:
+        print(f"\ncompared with {os.path.relpath(previous[0])} ({previous[1]['version'].get('commit')})")
+        regressed += compare(previous[1]["results"], results, args.tolerance)
+    else:
+        print("\nno previous run of this scenario to compare with")
+
+    if not args.no_save:
+        os.makedirs(args.results_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{args.label or args.server}.json"
+        path = os.path.join(args.results_dir, name)
+        with open(path, "w") as f:
+            json.dump({"scenario": scenario, "version": version_info(), "time": time.time(), "results": results}, f, indent=2)
+        print(f"saved {os.path.relpath(path)}")
+
+    if regressed and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Peak memory per image job: fully buffered vs streamed provider -> Telegram path.
+
+Starts a local HTTP server that plays both an image provider (raw bytes like
+Pollinations/Hugging Face, base64 JSON like Stability) and Telegram's sendPhoto,
+then runs the same job through the old buffered code path and the streaming
+path in app.py, measuring Python heap peaks with tracemalloc.
+
+    python benchmarks/bench_memory.py --size-mb 8 --jobs 5
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import sys
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+PAYLOADS = {}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = PAYLOADS.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        view = memoryview(body)
+        for start in range(0, len(body), 64 * 1024):
+            self.wfile.write(view[start:start + 64 * 1024])
+
+    def do_POST(self):
+        # Fake sendPhoto: drain the upload without keeping it
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 64 * 1024)))
+        body = json.dumps({"ok": True, "result": {"photo": [{"file_id": "bench"}]}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def buffered_job(base, kind):
+    """The original path: response.content / JSON + b64decode, then an in-memory multipart body"""
+    response = requests.get(f"{base}/{kind}", timeout=60)
+    if kind == "json":
+        image_data = base64.b64decode(response.json()["artifacts"][0]["base64"])
+    else:
+        image_data = response.content
+    files = {"photo": ("image.png", io.BytesIO(image_data), "image/png")}
+    requests.post(f"{base}/sendPhoto", files=files, data={"chat_id": 1, "caption": "bench"}, timeout=60)
+
+def streaming_job(base, kind):
+    """The streaming path: chunks into a spooled file, then a lazily read multipart body"""
+    with app.http_request("GET", f"{base}/{kind}", stream=True) as response:
+        image = app.read_image_stream(response, base64_artifact=(kind == "json"))
+    body = app.MultipartStream({"chat_id": 1, "caption": "bench"}, "photo", "image.png", "image/png", image)
+    app.http_request("POST", f"{base}/sendPhoto", data=body, headers={"Content-Type": body.content_type})
+    image.close()
+
+def measure(job, base, kind, jobs):
+    peaks = []
+    for _ in range(jobs):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        job(base, kind)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    return max(peaks)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=8, help="decoded image size")
+    parser.add_argument("--jobs", type=int, default=5, help="jobs per path (the max peak is reported)")
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    if size > app.MAX_IMAGE_BYTES:
+        parser.error(f"--size-mb is above MAX_IMAGE_BYTES ({app.MAX_IMAGE_BYTES} bytes)")
+    image = os.urandom(size)
+    PAYLOADS["/raw"] = image
+    PAYLOADS["/json"] = json.dumps({"artifacts": [{"base64": base64.b64encode(image).decode(), "seed": 1}]}).encode()
+    del image
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    tracemalloc.start()
+    print(f"image size {args.size_mb:.1f} MiB, spool threshold {app.IMAGE_SPOOL_BYTES / 2**20:.1f} MiB")
+    print(f"{'provider body':<16}{'buffered peak':>16}{'streaming peak':>16}")
+    for kind, label in (("raw", "raw bytes"), ("json", "base64 JSON")):
+        buffered = measure(buffered_job, base, kind, args.jobs)
+        streaming = measure(streaming_job, base, kind, args.jobs)
+        print(f"{label:<16}{buffered / 2**20:>13.1f} MiB{streaming / 2**20:>13.1f} MiB")
+    tracemalloc.stop()
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
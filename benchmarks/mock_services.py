@@ -0,0 +1,266 @@
+"""Local stand-ins for the Telegram Bot API and the three image providers.
+
+Each service runs in its own ThreadingHTTPServer so connections can be counted
+per service. Latency, error rate, 429 rate and image size are configurable:
+
+    services = start_mock_services(latency={"stability": "lognormal:2,0.4"}, error_rate={"huggingface": 0.2})
+    os.environ.update(service_env(services))  # TELEGRAM_API_BASE=http://127.0.0.1:..., etc.
+
+The Telegram stand-in records every photo and message sent to each chat, in
+order. End-to-end latency is measured against the first one; any further reply
+to a chat shows up as a problem in the report.
+"""
+import base64
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    from PIL import Image
+except ImportError:  # Without Pillow the stand-ins return random bytes behind a PNG signature
+    Image = None
+
+SERVICES = ("telegram", "stability", "pollinations", "huggingface")
+DEFAULT_LATENCY = {
+    "telegram": "lognormal:0.05,0.3",
+    "stability": "lognormal:2,0.4",
+    "pollinations": "lognormal:1.5,0.5",
+    "huggingface": "lognormal:3,0.5",
+}
+
+def parse_latency(spec):
+    """Build a sampler from "fixed:S", "uniform:LOW,HIGH", "normal:MEAN,SD" or "lognormal:MEDIAN,SIGMA" (seconds)"""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(*values)
+    if kind == "normal" and len(values) == 2:
+        return lambda: max(0.0, random.gauss(*values))
+    if kind == "lognormal" and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    raise ValueError(f"Bad latency distribution: {spec!r}")
+
+def make_image(pixels):
+    """A noisy PNG of pixels x pixels, so post-processing has real work to do"""
+    if Image is None:
+        return b"\x89PNG\r\n\x1a\n" + random.randbytes(pixels * pixels * 3)
+    out = io.BytesIO()
+    Image.effect_noise((pixels, pixels), 64).convert("RGB").save(out, format="PNG")
+    return out.getvalue()
+
+class MockService(ThreadingHTTPServer):
+    """One stand-in service with its own behaviour and counters"""
+    daemon_threads = True
+
+    def __init__(self, name, handler, latency, error_rate=0.0, rate_limit=0.0, retry_after=1, image=b""):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.name = name
+        self.sample_latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.image = image
+        self.lock = threading.Lock()
+        self.counters = {"connections": 0, "requests": 0, "errors": 0, "throttled": 0, "bytes_in": 0, "bytes_out": 0}
+        self.deliveries = {}  # Telegram only: chat_id -> [(time.monotonic(), "photo" or "message"), ...]
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def bump(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.bump("connections")  # One handler instance per TCP connection
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.bump("bytes_in", len(body))
+        return body
+
+    def reply(self, status, body, content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.bump("bytes_out", len(body))
+
+    def injected_failure(self):
+        """Sleep for the sampled latency, then maybe answer with an injected 429 or 500"""
+        self.server.bump("requests")
+        time.sleep(self.server.sample_latency())
+        roll = random.random()
+        if roll < self.server.rate_limit:
+            self.server.bump("throttled")
+            self.reply(429, self.throttled_body())
+            return True
+        if roll < self.server.rate_limit + self.server.error_rate:
+            self.server.bump("errors")
+            self.reply(500, {"error": "injected failure"})
+            return True
+        return False
+
+    def throttled_body(self):
+        return {"error": "rate limited"}
+
+    def do_GET(self):
+        self.handle_call("GET", b"")
+
+    def do_POST(self):
+        self.handle_call("POST", self.read_body())
+
+class TelegramHandler(MockHandler):
+    """sendMessage, sendPhoto, sendChatAction, setWebhook, getWebhookInfo, deleteWebhook and getUpdates"""
+
+    def throttled_body(self):
+        retry_after = self.server.retry_after
+        return {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}", "parameters": {"retry_after": retry_after}}
+
+    def chat_id(self, body):
+        if self.headers.get("Content-Type", "").startswith("multipart/form-data"):
+            match = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+            return int(match.group(1)) if match else None
+        try:
+            return int(json.loads(body or b"{}").get("chat_id"))
+        except (TypeError, ValueError):
+            return None
+
+    def handle_call(self, verb, body):
+        method = urlsplit(self.path).path.rsplit("/", 1)[-1]
+        if method == "getUpdates":
+            # Nothing to deliver: behave like an idle long poll
+            timeout = float(parse_qs(urlsplit(self.path).query).get("timeout", ["0"])[0])
+            time.sleep(min(timeout, 1.0))
+            self.reply(200, {"ok": True, "result": []})
+            return
+        if method in ("setWebhook", "deleteWebhook"):
+            self.reply(200, {"ok": True, "result": True, "description": "Webhook was set"})
+            return
+        if method == "getWebhookInfo":
+            self.reply(200, {"ok": True, "result": {"url": "", "pending_update_count": 0}})
+            return
+        if method not in ("sendMessage", "sendPhoto", "sendChatAction"):
+            self.reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            return
+
+        if self.injected_failure():
+            return
+        chat_id = self.chat_id(body)
+        if method != "sendChatAction" and chat_id is not None:
+            with self.server.lock:
+                self.server.deliveries.setdefault(chat_id, []).append((time.monotonic(), "photo" if method == "sendPhoto" else "message"))
+
+        result = {"message_id": random.randint(1, 2**31), "chat": {"id": chat_id}}
+        if method == "sendPhoto":
+            result["photo"] = [{"file_id": f"mock-{chat_id}-small"}, {"file_id": f"mock-{chat_id}"}]
+        self.reply(200, {"ok": True, "result": True if method == "sendChatAction" else result})
+
+class StabilityHandler(MockHandler):
+    """POST /v1/generation/<engine>/text-to-image and GET /v1/engines/list"""
+
+    def handle_call(self, verb, body):
+        path = urlsplit(self.path).path
+        if path == "/v1/engines/list":
+            self.reply(200, [{"id": "stable-diffusion-v1-6", "type": "PICTURE"}])
+            return
+        if not path.endswith("/text-to-image"):
+            self.reply(404, {"message": "not found"})
+            return
+        if self.injected_failure():
+            return
+        artifact = base64.b64encode(self.server.image).decode()
+        self.reply(200, {"artifacts": [{"base64": artifact, "seed": 1, "finishReason": "SUCCESS"}]})
+
+class PollinationsHandler(MockHandler):
+    """GET /prompt/<prompt> and GET /models"""
+
+    def handle_call(self, verb, body):
+        path = urlsplit(self.path).path
+        if path == "/models":
+            self.reply(200, ["flux", "turbo"])
+            return
+        if not path.startswith("/prompt/"):
+            self.reply(404, {"error": "not found"})
+            return
+        if self.injected_failure():
+            return
+        self.reply(200, self.server.image, "image/png")
+
+class HuggingFaceHandler(MockHandler):
+    """POST /models/<model> and GET /status/<model>"""
+
+    def handle_call(self, verb, body):
+        path = urlsplit(self.path).path
+        if path.startswith("/status/"):
+            self.reply(200, {"loaded": True, "state": "Loaded"})
+            return
+        if not path.startswith("/models/"):
+            self.reply(404, {"error": "not found"})
+            return
+        if self.injected_failure():
+            return
+        self.reply(200, self.server.image, "image/png")
+
+HANDLERS = {
+    "telegram": TelegramHandler,
+    "stability": StabilityHandler,
+    "pollinations": PollinationsHandler,
+    "huggingface": HuggingFaceHandler,
+}
+
+def start_mock_services(latency=None, error_rate=None, rate_limit=None, retry_after=1, image_pixels=512):
+    """Start all four stand-ins on free local ports. Returns {service name: MockService}."""
+    latency = dict(DEFAULT_LATENCY, **(latency or {}))
+    error_rate = error_rate or {}
+    rate_limit = rate_limit or {}
+    image = make_image(image_pixels)
+
+    services = {}
+    for name in SERVICES:
+        server = MockService(
+            name, HANDLERS[name], latency[name],
+            error_rate=error_rate.get(name, 0.0), rate_limit=rate_limit.get(name, 0.0),
+            retry_after=retry_after, image=image,
+        )
+        threading.Thread(target=server.serve_forever, name=f"mock-{name}", daemon=True).start()
+        services[name] = server
+    return services
+
+def service_env(services):
+    """Environment variables that point app.py (and async_app.py) at the stand-ins"""
+    return {
+        "TELEGRAM_API_BASE": services["telegram"].base_url,
+        "STABILITY_API_BASE": services["stability"].base_url,
+        "POLLINATIONS_API_BASE": services["pollinations"].base_url,
+        "HUGGINGFACE_API_BASE": services["huggingface"].base_url,
+    }
+
+def stop_mock_services(services):
+    for server in services.values():
+        server.shutdown()
+        server.server_close()
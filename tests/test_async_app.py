@@ -0,0 +1,55 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+import app
+import async_app
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 64
+
+def test_send_photo_retries_after_429_and_leaves_the_image_open(monkeypatch):
+    uploads = []
+
+    async def send_photo(request):
+        body = await request.read()
+        uploads.append((request.headers.get("Content-Length"), body))
+        if len(uploads) == 1:
+            return web.json_response(
+                {"ok": False, "error_code": 429, "parameters": {"retry_after": 0}}, status=429
+            )
+        return web.json_response({"ok": True, "result": {"photo": [{"file_id": "small"}, {"file_id": "large"}]}})
+
+    async def scenario():
+        telegram = web.Application()
+        telegram.router.add_post("/bot{token}/sendPhoto", send_photo)
+        runner = web.AppRunner(telegram)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(app, "TELEGRAM_API_BASE", f"http://127.0.0.1:{port}")
+
+        async_app._session = aiohttp.ClientSession()
+        try:
+            # The spooled file providers produce, not a BytesIO, which aiohttp would copy
+            sink = app.ImageSink()
+            sink.write(PNG)
+            image = sink.finish()
+            sent = await async_app.send_telegram_photo(42, image, "caption")
+            assert not image.closed
+            image.seek(0)
+            assert image.read() == PNG  # Still usable for coalesced waiters
+            return sent
+        finally:
+            await async_app._session.close()
+            await runner.cleanup()
+
+    sent = asyncio.run(scenario())
+
+    assert app.photo_file_id(sent) == "large"
+    assert len(uploads) == 2
+    for content_length, body in uploads:
+        assert content_length is not None
+        assert PNG in body
+        assert b'name="chat_id"' in body and b"\r\n\r\n42\r\n" in body
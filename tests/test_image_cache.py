@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+import app
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "IMAGE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "IMAGE_CACHE_MEMORY_ITEM_BYTES", 10)  # Everything stays on disk only
+    monkeypatch.setattr(app, "_memory_cache", app.OrderedDict())
+    return tmp_path
+
+def test_disk_limit_counts_entries_written_by_other_processes(cache_dir, monkeypatch):
+    monkeypatch.setattr(app, "IMAGE_CACHE_DISK_BYTES", 250)
+    (cache_dir / "other.img").write_bytes(b"x" * 200)  # Another worker's entry
+    (cache_dir / "other.json").write_bytes(b"{}")
+    os.utime(cache_dir / "other.img", (1, 1))
+
+    app.cache_put("mine", b"y" * 100)
+
+    assert not (cache_dir / "other.img").exists()
+    assert (cache_dir / "mine.img").exists()
+    assert app.cache_stats()["disk_bytes"] <= 250
+
+def test_stale_temp_files_are_removed(cache_dir):
+    stale = cache_dir / "gone.img.123.456.tmp"
+    stale.write_bytes(b"partial")
+    os.utime(stale, (1, 1))
+    fresh = cache_dir / "busy.img.123.789.tmp"
+    fresh.write_bytes(b"partial")
+
+    app.cache_put("mine", b"y" * 100)
+
+    assert not stale.exists()
+    assert fresh.exists()
+
+def test_cached_image_is_closed_after_a_file_id_resend(cache_dir, monkeypatch):
+    app.cache_put("key", b"y" * 100, file_id="abc")
+    opened = []
+    original_cache_get = app.cache_get
+
+    def cache_get(key):
+        cached = original_cache_get(key)
+        opened.append(cached["image"])
+        return cached
+
+    monkeypatch.setattr(app, "cache_get", cache_get)
+    monkeypatch.setattr(app, "image_cache_key", lambda prompt: "key")
+    monkeypatch.setattr(app, "send_telegram_photo_url", lambda chat_id, file_id, caption: True)
+
+    app.handle_text_message(1, "cat")
+
+    assert opened[0] is not None and opened[0].closed
@@ -0,0 +1,70 @@
+import pytest
+
+import app
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, "time", lambda: now[0])
+    monkeypatch.setattr(app, "JOB_LEASE_SECONDS", 60)
+    monkeypatch.setattr(app, "JOB_MAX_ATTEMPTS", 2)
+    return now
+
+@pytest.fixture
+def store(tmp_path, clock):
+    return app.SQLiteJobStore(str(tmp_path / "jobs.sqlite3"))
+
+def test_lease_claims_queued_jobs_once(store):
+    first = store.enqueue(1, "cat", 10)
+    second = store.enqueue(2, "dog", 10)
+
+    assert store.lease("a", 1) == [(first, 1, "cat")]
+    assert store.lease("b", 10) == [(second, 2, "dog")]
+    assert store.lease("c", 10) == []
+    assert store.counts() == {"leased": 2}
+
+def test_enqueue_rejects_when_full(store):
+    assert store.enqueue(1, "cat", 1) is not None
+    assert store.enqueue(2, "dog", 1) is None
+
+def test_expired_lease_is_reclaimed_and_stale_owner_cannot_complete(store, clock):
+    job = store.enqueue(1, "cat", 10)
+    store.lease("a", 10)
+    clock[0] += 61
+
+    assert store.lease("b", 10) == [(job, 1, "cat")]
+    assert not store.complete(job, "a")
+    assert store.counts() == {"leased": 1}
+    assert store.complete(job, "b")
+    assert store.counts() == {"done": 1}
+
+def test_renew_keeps_a_running_job_from_being_reclaimed(store, clock):
+    job = store.enqueue(1, "cat", 10)
+    store.lease("a", 10)
+    clock[0] += 50
+    assert store.renew("a") == 1
+    clock[0] += 50
+
+    assert store.lease("b", 10) == []
+    assert store.renew("b") == 0
+    assert store.complete(job, "a")
+
+def test_job_fails_after_max_attempts_and_late_completion_is_ignored(store, clock):
+    job = store.enqueue(1, "cat", 10)
+    store.lease("a", 10)
+    clock[0] += 61
+    store.lease("b", 10)
+    clock[0] += 61
+
+    assert store.lease("c", 10) == []  # Second lease expired on the last attempt
+    assert store.counts() == {"failed": 1}
+    assert not store.complete(job, "a")
+    assert not store.complete(job, "b")
+    assert store.counts() == {"failed": 1}
+
+def test_complete_can_requeue_a_job(store):
+    job = store.enqueue(1, "cat", 10)
+    store.lease("a", 10)
+
+    assert store.complete(job, "a", "queued")
+    assert store.lease("b", 10) == [(job, 1, "cat")]
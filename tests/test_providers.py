@@ -0,0 +1,58 @@
+import app
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256))
+
+def only_provider(monkeypatch, generate):
+    monkeypatch.setattr(app, "PROVIDERS", [])
+    return app.register_provider("Test", generate)
+
+def test_provider_may_return_bytes(monkeypatch):
+    provider = only_provider(monkeypatch, lambda prompt: PNG)
+
+    image = app.generate_image("cat")
+
+    assert image.read() == PNG
+    assert provider.error_rate == 0.0
+
+def test_provider_returning_something_else_counts_as_a_failure(monkeypatch):
+    provider = only_provider(monkeypatch, lambda prompt: 42)
+
+    assert app.generate_image("cat") is None
+    assert provider.consecutive_failures == 1
+
+def test_half_open_circuit_allows_a_single_trial(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(app, "CIRCUIT_FAILURE_THRESHOLD", 1)
+    monkeypatch.setattr(app, "CIRCUIT_RESET_SECONDS", 30)
+    provider = app.ImageProvider("Test", lambda prompt: None)
+
+    assert provider.begin() is False
+    provider.record(False, 1.0)
+    assert provider.begin() is None  # Open
+    now[0] += 31
+
+    assert provider.begin() is True  # Half-open: the first caller gets the trial
+    assert provider.begin() is None  # Everyone else waits for its result
+    assert not provider.available(now[0])
+
+    provider.record(False, 1.0)  # A straggler from before does not end the trial
+    assert provider.trial_in_flight
+    provider.record(False, 1.0, trial=True)  # The trial failing reopens the circuit
+    assert provider.begin() is None
+    now[0] += 31
+
+    assert provider.begin() is True
+    provider.record(True, 1.0, trial=True)  # The trial succeeding closes it
+    assert provider.begin() is False
+    assert provider.stats()["circuit"] == "closed"
+
+def test_abandoned_trial_lets_the_next_call_try(monkeypatch):
+    provider = app.ImageProvider("Test", lambda prompt: None)
+    provider.open_until = app.time.monotonic() - 1
+
+    assert provider.begin() is True
+    provider.abandon(False)
+    assert provider.begin() is None
+    provider.abandon(True)
+    assert provider.begin() is True